@@ -0,0 +1,85 @@
+"""
+Compare the ORM export of activities with the streaming Core read path
+used by Generator.load.
+
+    python run_page/benchmarks/export_benchmark.py --count 10000
+"""
+
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from generator import Generator
+from generator.db import Activity, bulk_upsert_activities
+from sqlalchemy.orm import selectinload
+from storage_benchmark import fake_activities
+
+
+def orm_load(session):
+    activities = (
+        session.query(Activity)
+        .options(selectinload(Activity.geometry))
+        .filter(Activity.distance > 0.1)
+        .order_by(Activity.start_date_local)
+    )
+    activity_list = []
+    streak = 0
+    last_date = None
+    for activity in activities:
+        date = datetime.datetime.strptime(
+            activity.start_date_local, "%Y-%m-%d %H:%M:%S"
+        ).date()
+        if last_date is None:
+            streak = 1
+        elif date == last_date:
+            pass
+        elif date == last_date + datetime.timedelta(days=1):
+            streak += 1
+        else:
+            streak = 1
+        activity.streak = streak
+        last_date = date
+        activity_list.append(activity.to_dict())
+    return activity_list
+
+
+def best_of(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - t)
+    return min(timings), result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=10000, help="activities")
+    parser.add_argument("--points", type=int, default=200, help="points per track")
+    parser.add_argument("--repeat", type=int, default=3)
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        generator = Generator(os.path.join(tmp, "data.db"))
+        bulk_upsert_activities(
+            generator.session, fake_activities(options.count, options.points)
+        )
+        generator.session.commit()
+
+        orm_time, orm_list = best_of(
+            lambda: orm_load(generator.session), options.repeat
+        )
+        generator.session.expunge_all()
+        # "all" without hiding polylines, like orm_load
+        core_time, core_list = best_of(
+            lambda: generator._load_activities("all"),
+            options.repeat,
+        )
+        assert orm_list == core_list, "export output changed"
+        print(f"orm:  {orm_time:.3f}s")
+        print(f"core: {core_time:.3f}s ({orm_time / core_time:.1f}x)")
@@ -0,0 +1,68 @@
+"""
+Compare garmin_fit_sdk.Decoder.read with the session/record only reader
+used by load_fit_file, over every FIT file of a directory.
+
+    python run_page/benchmarks/fit_benchmark.py --dir FIT_OUT
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import numpy as np
+from config import FIT_FOLDER
+from export_benchmark import best_of
+from garmin_fit_sdk import Decoder, Stream
+from gpxtrackposter.fit_reader import read_fit, records_from_messages
+
+
+def sdk_read(file_names):
+    result = []
+    for file_name in file_names:
+        messages, _ = Decoder(Stream.from_file(file_name)).read(
+            convert_datetimes_to_dates=False
+        )
+        result.append(
+            (
+                messages["session_mesgs"][0],
+                records_from_messages(messages.get("record_mesgs", [])),
+            )
+        )
+    return result
+
+
+def fast_read(file_names):
+    return [read_fit(file_name) for file_name in file_names]
+
+
+def check(sdk_result, fast_result):
+    for (sdk_session, sdk_records), (session, records) in zip(sdk_result, fast_result):
+        for key, value in session.items():
+            assert sdk_session[key] == value, f"session {key} changed"
+        for sdk_values, values in zip(sdk_records, records):
+            assert np.array_equal(sdk_values, values, equal_nan=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", default=FIT_FOLDER, help="folder of FIT files")
+    parser.add_argument("--repeat", type=int, default=3)
+    options = parser.parse_args()
+
+    file_names = [
+        os.path.join(options.dir, name)
+        for name in sorted(os.listdir(options.dir))
+        if name.lower().endswith(".fit")
+        and os.path.getsize(os.path.join(options.dir, name))
+    ]
+    if not file_names:
+        sys.exit(f"no FIT files in {options.dir}")
+
+    sdk_time, sdk_result = best_of(lambda: sdk_read(file_names), options.repeat)
+    fast_time, fast_result = best_of(lambda: fast_read(file_names), options.repeat)
+    check(sdk_result, fast_result)
+    print(f"{len(file_names)} files")
+    print(f"sdk:  {sdk_time:.3f}s")
+    print(f"fast: {fast_time:.3f}s ({sdk_time / fast_time:.1f}x)")
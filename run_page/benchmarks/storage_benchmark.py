@@ -0,0 +1,104 @@
+"""
+Compare ingest and export throughput of the data.db storage profiles.
+
+    python run_page/benchmarks/storage_benchmark.py --count 10000
+"""
+
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import polyline_codec
+from config import run_map, start_point
+from generator.db import Activity, bulk_upsert_activities, init_db
+from generator.storage import STORAGE_PROFILES
+from sqlalchemy.orm import selectinload
+
+
+def fake_activities(count, points):
+    fields = (
+        "id name distance moving_time elapsed_time type start_date "
+        "start_date_local average_heartrate average_speed map source "
+        "start_latlng location_country"
+    )
+    x = namedtuple("x", fields)
+    start = datetime.datetime(2015, 1, 1)
+    line = polyline_codec.encode(
+        [(30 + i * 1e-4, 120 + (i % 7) * 1e-4) for i in range(points)]
+    )
+    for i in range(count):
+        start_date = start + datetime.timedelta(hours=7 * i)
+        yield x(
+            id=int(start_date.timestamp() * 1000),
+            name=f"run {i}",
+            distance=5000.0 + i,
+            moving_time=datetime.timedelta(seconds=1800 + i % 600),
+            elapsed_time=datetime.timedelta(seconds=1900 + i % 600),
+            type="Run",
+            start_date=start_date.strftime("%Y-%m-%d %H:%M:%S"),
+            start_date_local=start_date.strftime("%Y-%m-%d %H:%M:%S"),
+            average_heartrate=150.0,
+            average_speed=2.8,
+            map=run_map(line),
+            source="benchmark",
+            start_latlng=start_point(30, 120),
+            # skip reverse geocoding
+            location_country="benchmark",
+        )
+
+
+def run_profile(profile, count, points):
+    with tempfile.TemporaryDirectory() as tmp:
+        session = init_db(os.path.join(tmp, "data.db"), profile)
+        activities = list(fake_activities(count, points))
+
+        t = time.perf_counter()
+        bulk_upsert_activities(session, activities)
+        session.commit()
+        ingest = time.perf_counter() - t
+
+        t = time.perf_counter()
+        bulk_upsert_activities(session, activities)
+        session.commit()
+        resync = time.perf_counter() - t
+
+        t = time.perf_counter()
+        exported = [
+            a.to_dict()
+            for a in session.query(Activity)
+            .options(selectinload(Activity.geometry))
+            .filter(Activity.distance > 0.1)
+            .order_by(Activity.start_date_local)
+        ]
+        export = time.perf_counter() - t
+        assert len(exported) == count
+        session.close()
+        session.get_bind().dispose()
+    return ingest, resync, export
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=5000, help="activities")
+    parser.add_argument("--points", type=int, default=500, help="points per track")
+    parser.add_argument(
+        "--profile",
+        dest="profiles",
+        action="append",
+        choices=list(STORAGE_PROFILES),
+        help="profiles to compare, all by default",
+    )
+    options = parser.parse_args()
+    print(f"{'profile':<10}{'ingest/s':>12}{'resync/s':>12}{'export/s':>12}")
+    for profile in options.profiles or STORAGE_PROFILES:
+        ingest, resync, export = run_profile(profile, options.count, options.points)
+        print(
+            f"{profile:<10}{options.count / ingest:>12.0f}"
+            f"{options.count / resync:>12.0f}{options.count / export:>12.0f}"
+        )
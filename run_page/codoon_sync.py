@@ -13,7 +13,7 @@ from datetime import datetime, timedelta
 import eviltransform
 import gpxpy
 import numpy as np
-import polyline
+import polyline_simplifier
 import requests
 from config import (
     BASE_TIMEZONE,
@@ -21,10 +21,10 @@ from config import (
     JSON_FILE,
     SQL_FILE,
     TCX_FOLDER,
-    run_map,
     start_point,
 )
 from generator import Generator
+from generator.manifest import DirectoryManifest
 from tzlocal import get_localzone
 from utils import adjust_time_to_utc, adjust_timestamp_to_utc, to_date
 
@@ -518,7 +518,6 @@ class Codoon:
         if heart_rate_dict:
             heart_rate = sum(heart_rate_dict.values()) / len(heart_rate_dict)
 
-        polyline_str = polyline.encode(latlng_data) if latlng_data else ""
         start_latlng = start_point(*latlng_data[0]) if latlng_data else None
         start_date = self._gt(start_time)
         end_date = self._gt(end_time)
@@ -541,7 +540,7 @@ class Codoon:
             "end_local": datetime.strftime(end_date, "%Y-%m-%d %H:%M:%S"),
             "length": run_data["total_length"],
             "average_heartrate": heart_rate,
-            "map": run_map(polyline_str),
+            "map": polyline_simplifier.simplified_map(latlng_data),
             "start_latlng": start_latlng,
             "distance": run_data["total_length"],
             "moving_time": timedelta(seconds=run_data["total_time"]),
@@ -554,12 +553,11 @@ class Codoon:
         }
         return namedtuple("x", d.keys())(*d.values())
 
-    def get_old_tracks(self, old_ids, with_gpx=False, with_tcx=False):
+    def get_old_tracks(self, sync_state, with_gpx=False, with_tcx=False):
         run_records = self.get_runs_records()
 
-        old_gpx_ids = os.listdir(GPX_FOLDER)
-        old_gpx_ids = [i.split(".")[0] for i in old_gpx_ids if not i.startswith(".")]
-        new_run_routes = [i for i in run_records if str(i["log_id"]) not in old_ids]
+        old_gpx_ids = DirectoryManifest(GPX_FOLDER).ids()
+        new_run_routes = [i for i in run_records if i["log_id"] not in sync_state]
         tracks = []
         for i in new_run_routes:
             run_data = self.get_single_run_record(i["route_id"])
@@ -608,10 +606,9 @@ if __name__ == "__main__":
         j.login_by_phone()
 
     generator = Generator(SQL_FILE)
-    old_tracks_ids = generator.get_old_tracks_ids()
-    tracks = j.get_old_tracks(old_tracks_ids, options.with_gpx, options.with_tcx)
+    sync_state = generator.sync_state("codoon", activity_source="Codoon")
+    tracks = j.get_old_tracks(sync_state, options.with_gpx, options.with_tcx)
 
-    generator.sync_from_app(tracks)
-    activities_list = generator.load()
-    with open(JSON_FILE, "w") as f:
-        json.dump(activities_list, f, indent=0)
+    sync_state.update(generator.sync_from_app(tracks))
+    sync_state.save()
+    generator.export_json(JSON_FILE)
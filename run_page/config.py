@@ -17,6 +17,7 @@ FOLDER_DICT = {
     "fit": FIT_FOLDER,
 }
 SQL_FILE = os.path.join(parent, "run_page", "data.db")
+TRACK_CACHE_FILE = os.path.join(parent, "run_page", "track_cache.db")
 JSON_FILE = os.path.join(parent, "src", "static", "activities.json")
 SYNCED_FILE = os.path.join(parent, "imported.json")
 SYNCED_ACTIVITY_FILE = os.path.join(parent, "synced_activity.json")
@@ -28,7 +29,13 @@ BASE_TIMEZONE = "Asia/Shanghai"
 
 
 start_point = namedtuple("start_point", "lat lon")
-run_map = namedtuple("polyline", "summary_polyline")
+# simplify_tolerance and simplify_max_points are the polyline_simplifier
+# settings the polyline was made with, None when it is stored as received
+run_map = namedtuple(
+    "polyline",
+    "summary_polyline simplify_tolerance simplify_max_points",
+    defaults=(None, None),
+)
 
 try:
     with open("config.yaml") as f:
@@ -17,8 +17,8 @@ def apply_duration_time(d):
         return ""
 
 
-# we do not need polyline in csv
-df = df.drop("summary_polyline", axis=1)
+# we do not need polyline in csv, data.db keeps it in activity_geometry now
+df = df.drop(columns="summary_polyline", errors="ignore")
 df["elapsed_time"] = df["elapsed_time"].apply(apply_duration_time)
 df["moving_time"] = df["moving_time"].apply(apply_duration_time)
 
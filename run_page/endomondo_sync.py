@@ -8,15 +8,15 @@ import os
 from collections import namedtuple
 from datetime import datetime, timedelta
 
-import polyline
+import polyline_simplifier
 from config import BASE_TIMEZONE, ENDOMONDO_FILE_DIR, JSON_FILE, SQL_FILE
 from generator import Generator
+from generator.manifest import DirectoryManifest
 
 from utils import adjust_time
 
 # TODO Same as keep_sync maybe refactor
 start_point = namedtuple("start_point", "lat lon")
-run_map = namedtuple("polyline", "summary_polyline")
 
 
 def _make_heart_rate(en_dict):
@@ -41,7 +41,6 @@ def parse_run_endomondo_to_nametuple(en_dict):
                 # WTF TODO? maybe more points?
                 lat, lon = attr.get("location")[0]
                 location_points.append([lat.get("latitude"), lon.get("longitude")])
-    polyline_str = polyline.encode(location_points) if location_points else ""
     start_latlng = start_point(*location_points[0]) if location_points else None
     start_date = en_dict.get("start_time")
     start_date = datetime.strptime(start_date, "%Y-%m-%d %H:%M:%S.%f")
@@ -60,7 +59,7 @@ def parse_run_endomondo_to_nametuple(en_dict):
         "end_local": datetime.strftime(end_date_local, "%Y-%m-%d %H:%M:%S"),
         "length": en_dict.get("distance_km", 0) * 1000,
         "average_heartrate": int(heart_rate) if heart_rate else None,
-        "map": run_map(polyline_str),
+        "map": polyline_simplifier.simplified_map(location_points),
         "start_latlng": start_latlng,
         "distance": en_dict.get("distance_km", 0) * 1000,
         "moving_time": timedelta(seconds=en_dict.get("duration_s", 0)),
@@ -90,28 +89,27 @@ def parse_one_endomondo_json(json_file_name):
 
 
 def get_all_en_endomondo_json_file(file_dir=ENDOMONDO_FILE_DIR):
-    dirs = os.listdir(file_dir)
-    json_files = [os.path.join(file_dir, i) for i in dirs if i.endswith(".json")]
+    names = DirectoryManifest(file_dir).names("json")
+    json_files = [os.path.join(file_dir, i) for i in names]
     return json_files
 
 
 def run_enomondo_sync():
     generator = Generator(SQL_FILE)
-    old_tracks_ids = generator.get_old_tracks_ids()
+    sync_state = generator.sync_state("endomondo")
     json_files_list = get_all_en_endomondo_json_file()
     if not json_files_list:
         raise Exception("No json files found in {}".format(ENDOMONDO_FILE_DIR))
     tracks = []
     for i in json_files_list:
-        if _make_endomondo_id(i) in old_tracks_ids:
+        if _make_endomondo_id(i) in sync_state:
             continue
         en_dict = parse_one_endomondo_json(i)
         track = parse_run_endomondo_to_nametuple(en_dict)
         tracks.append(track)
-    generator.sync_from_app(tracks)
-    activities_list = generator.load()
-    with open(JSON_FILE, "w") as f:
-        json.dump(activities_list, f, indent=0)
+    sync_state.update(generator.sync_from_app(tracks))
+    sync_state.save()
+    generator.export_json(JSON_FILE)
 
 
 if __name__ == "__main__":
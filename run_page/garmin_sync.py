@@ -19,6 +19,7 @@ import garth
 import httpx
 from config import FOLDER_DICT, JSON_FILE, SQL_FILE, config
 from garmin_device_adaptor import wrap_device_info
+from generator.manifest import DirectoryManifest
 from utils import make_activities_file_only
 
 # logging.basicConfig(level=logging.DEBUG)
@@ -274,7 +275,7 @@ async def gather_with_concurrency(n, tasks):
 
 
 def get_downloaded_ids(folder):
-    return [i.split(".")[0] for i in os.listdir(folder) if not i.startswith(".")]
+    return DirectoryManifest(folder).ids()
 
 
 async def download_new_activities(
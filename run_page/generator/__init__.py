@@ -1,26 +1,45 @@
 import datetime
+import json
 import os
 import sys
 
 import arrow
 import stravalib
-from config import MAPPING_TYPE
+from config import TRACK_CACHE_FILE
 from gpxtrackposter import track_loader
-from sqlalchemy import func
+from sqlalchemy import func, select
 
 from polyline_processor import filter_out
 
-from .db import Activity, init_db, update_or_create_activity
-
-from synced_data_file_logger import save_synced_data_file_list
-
+from . import exporter, ingest
+from .db import (
+    ACTIVITY_KEYS,
+    Activity,
+    ActivityStreak,
+    ExportState,
+    bulk_upsert_activities,
+    geocode_cache_hit_rate,
+    geocode_cache_stats,
+    init_db,
+    iter_activity_rows,
+    streak_criteria,
+    update_or_create_activity,
+)
+from .manifest import DirectoryManifest
+from .storage import acquire_writer_lock
+from .sync_state import SourceSyncState
 
 IGNORE_BEFORE_SAVING = os.getenv("IGNORE_BEFORE_SAVING", False)
 
+# run_ids per query when re-reading changed activities for export
+EXPORT_CHUNK_SIZE = 500
+
 
 class Generator:
     def __init__(self, db_path):
         self.client = stravalib.Client()
+        # held until the process exits so overlapping syncs queue up
+        self.writer_lock = acquire_writer_lock(db_path)
         self.session = init_db(db_path)
 
         self.client_id = ""
@@ -46,6 +65,31 @@ class Generator:
         self.client.access_token = response["access_token"]
         print("Access ok")
 
+    @staticmethod
+    def _write_progress(status):
+        sys.stdout.write("+" if status == "created" else ".")
+        sys.stdout.flush()
+
+    @staticmethod
+    def _print_geocode_stats():
+        if geocode_cache_stats:
+            print(
+                f"geocode cache: {geocode_cache_stats['hit']} hits, "
+                f"{geocode_cache_stats['miss']} misses, "
+                f"hit rate {geocode_cache_hit_rate():.0%}"
+            )
+
+    def _bulk_upsert(self, run_activities):
+        stats = bulk_upsert_activities(
+            self.session, run_activities, on_progress=self._write_progress
+        )
+        print(
+            f"\n{stats.created} created, {stats.updated} updated, "
+            f"{stats.unchanged} unchanged"
+        )
+        self._print_geocode_stats()
+        return stats
+
     def sync(self, force):
         self.check_access()
 
@@ -61,42 +105,49 @@ class Generator:
             else:
                 filters = {"before": datetime.datetime.utcnow()}
 
-        for activity in self.client.get_activities(**filters):
-            if self.only_run and activity.type != "Run":
-                continue
-            if IGNORE_BEFORE_SAVING:
-                activity.summary_polyline = filter_out(activity.summary_polyline)
-            activity.source = "strava"
-            created = update_or_create_activity(self.session, activity)
-            if created:
-                sys.stdout.write("+")
-            else:
-                sys.stdout.write(".")
-            sys.stdout.flush()
+        def strava_activities():
+            for activity in self.client.get_activities(**filters):
+                if self.only_run and activity.type != "Run":
+                    continue
+                if IGNORE_BEFORE_SAVING:
+                    activity.summary_polyline = filter_out(activity.summary_polyline)
+                activity.source = "strava"
+                yield activity
+
+        self._bulk_upsert(strava_activities())
         self.session.commit()
 
-    def sync_from_data_dir(self, data_dir, file_suffix="gpx"):
-        loader = track_loader.TrackLoader()
-        tracks = loader.load_tracks(data_dir, file_suffix=file_suffix)
-        print(f"load {len(tracks)} tracks")
-        if not tracks:
+    def sync_from_data_dir(
+        self, data_dir, file_suffix="gpx", workers=None, chunk_size=None
+    ):
+        manifest = self.manifest(data_dir)
+        diff = manifest.diff(file_suffix)
+        manifest.save()
+        file_names = manifest.to_import(diff)
+        print(
+            f"{file_suffix.upper()} files: {len(diff.new)} new, "
+            f"{len(diff.changed)} changed, {len(diff.deleted)} deleted, "
+            f"{len(file_names)} to import"
+        )
+        loader = track_loader.TrackLoader(
+            cache_file=TRACK_CACHE_FILE, workers=workers, chunk_size=chunk_size
+        )
+        # diff() hashed the new and changed files, the cache needs no second pass
+        loader.cache.remember(manifest.hashes())
+        stats = ingest.ingest_files(
+            self.session, loader, file_names, file_suffix, diff.replaced
+        )
+        manifest.mark_imported(stats.imported)
+        manifest.save()
+        if not stats.imported and not stats.deleted:
             print("No tracks found.")
             return
-
-        synced_files = []
-
-        for t in tracks:
-            created = update_or_create_activity(self.session, t.to_namedtuple())
-            if created:
-                sys.stdout.write("+")
-            else:
-                sys.stdout.write(".")
-            synced_files.extend(t.file_names)
-            sys.stdout.flush()
-
-        save_synced_data_file_list(synced_files)
-
-        self.session.commit()
+        print(
+            f"{stats.created} created, {stats.updated} updated, "
+            f"{stats.unchanged} unchanged, {stats.merged} merged, "
+            f"{stats.deleted} deleted"
+        )
+        self._print_geocode_stats()
 
     def sync_from_kml_track(self, track):
         created = update_or_create_activity(self.session, track.to_namedtuple())
@@ -109,93 +160,157 @@ class Generator:
         self.session.commit()
 
     def sync_from_app(self, app_tracks):
+        """Upsert app_tracks, returns the run_ids that are stored now."""
         if not app_tracks:
             print("No tracks found.")
-            return
+            return []
         print("Syncing tracks '+' means new track '.' means update tracks")
-        synced_files = []
-        for t in app_tracks:
-            created = update_or_create_activity(self.session, t)
-            if created:
-                sys.stdout.write("+")
-            else:
-                sys.stdout.write(".")
-            if "file_names" in t:
-                synced_files.extend(t.file_names)
-            sys.stdout.flush()
+        stats = self._bulk_upsert(app_tracks)
 
         self.session.commit()
+        return stats.run_ids
+
+    def _export_options(self, for_mapping):
+        """Return the (streak kind, hide_polyline) of load() or loadForMapping()."""
+        if for_mapping:
+            return "mapping", False
+        return "run" if self.only_run else "all", not IGNORE_BEFORE_SAVING
+
+    @staticmethod
+    def _activity_dict(row, hide_polyline):
+        # rows carry the stored streak after the ACTIVITY_KEYS columns
+        activity = dict(zip(ACTIVITY_KEYS, row))
+        if hide_polyline:
+            activity["summary_polyline"] = filter_out(activity["summary_polyline"])
+        activity["streak"] = row[-1]
+        return activity
+
+    def _load_activities(self, kind, hide_polyline=False):
+        return [
+            self._activity_dict(row, hide_polyline)
+            for row in iter_activity_rows(
+                self.session, *streak_criteria(kind), streak_kind=kind
+            )
+        ]
 
     def load(self):
-        activities = (
-            self.session.query(Activity)
-            .filter(Activity.distance > 0.1)
-            .order_by(Activity.start_date_local)
+        return self._load_activities(*self._export_options(for_mapping=False))
+
+    def loadForMapping(self):
+        return self._load_activities(*self._export_options(for_mapping=True))
+
+    def export_json(self, json_file, for_mapping=False):
+        """
+        Write load() (or loadForMapping()) to json_file, reusing the text of
+        every record that did not change since the last export, and only
+        replace the file when its content changes.
+        """
+        kind, hide_polyline = self._export_options(for_mapping)
+        criteria = streak_criteria(kind)
+        signature = json.dumps(
+            [
+                "mapping" if for_mapping else "all",
+                self.only_run,
+                hide_polyline,
+                os.getenv("IGNORE_POLYLINE"),
+                os.getenv("IGNORE_RANGE"),
+                os.getenv("IGNORE_START_END_RANGE"),
+            ]
+        )
+        json_key = os.path.abspath(json_file)
+        state = self.session.get(ExportState, json_key)
+        old_content = exporter.read_json_file(json_file)
+        last_change = self.session.query(func.max(Activity.updated_at)).scalar() or 0
+        # deleting activities does not move last_change
+        row_count = (
+            self.session.query(func.count(Activity.run_id)).filter(*criteria).scalar()
         )
-        activity_list = []
-
-        streak = 0
-        last_date = None
-        for activity in activities:
-            if self.only_run and activity.type != "Run":
-                continue
-            # Determine running streak.
-            date = datetime.datetime.strptime(
-                activity.start_date_local, "%Y-%m-%d %H:%M:%S"
-            ).date()
-            if last_date is None:
-                streak = 1
-            elif date == last_date:
-                pass
-            elif date == last_date + datetime.timedelta(days=1):
-                streak += 1
-            else:
-                assert date > last_date
-                streak = 1
-            activity.streak = streak
-            last_date = date
-            if not IGNORE_BEFORE_SAVING:
-                activity.summary_polyline = filter_out(activity.summary_polyline)
-            activity_list.append(activity.to_dict())
 
-        return activity_list
+        old_records = None
+        if (
+            state
+            and state.signature == signature
+            and old_content is not None
+            and exporter.content_hash(old_content) == state.content_hash
+        ):
+            if (
+                state.exported_at is not None
+                and last_change <= state.exported_at
+                and row_count == state.row_count
+            ):
+                print(f"{json_file} is up to date")
+                return False
+            old_records = exporter.split_records(old_content)
 
-    def loadForMapping(self):
-        activities = (
-            self.session.query(Activity)
-            .filter(Activity.type.in_(MAPPING_TYPE))
+        rows = self.session.execute(
+            select(Activity.run_id, Activity.updated_at, ActivityStreak.streak)
+            .outerjoin(
+                ActivityStreak,
+                (ActivityStreak.kind == kind)
+                & (
+                    ActivityStreak.date == func.substr(Activity.start_date_local, 1, 10)
+                ),
+            )
+            .where(*criteria)
             .order_by(Activity.start_date_local)
+        ).all()
+
+        fragments = {}
+        if old_records:
+            for row in rows:
+                old = old_records.get(row.run_id)
+                if (
+                    old
+                    and old[0] == row.streak
+                    and (row.updated_at or 0) <= state.exported_at
+                ):
+                    fragments[row.run_id] = old[1]
+        stale = [row.run_id for row in rows if row.run_id not in fragments]
+        run_id_index = ACTIVITY_KEYS.index("run_id")
+        for i in range(0, len(stale), EXPORT_CHUNK_SIZE):
+            for row in iter_activity_rows(
+                self.session,
+                *criteria,
+                Activity.run_id.in_(stale[i : i + EXPORT_CHUNK_SIZE]),
+                streak_kind=kind,
+            ):
+                fragments[row[run_id_index]] = exporter.serialize_record(
+                    self._activity_dict(row, hide_polyline)
+                )
+        print(
+            f"export {json_file}: {len(stale)} records serialized, "
+            f"{len(rows) - len(stale)} reused"
         )
-        activity_list = []
-
-        streak = 0
-        last_date = None
-        for activity in activities:
-            # Determine running streak.
-            # if activity.type == "Run" or activity.type == "Walk":
-            date = datetime.datetime.strptime(
-                activity.start_date_local, "%Y-%m-%d %H:%M:%S"
-            ).date()
-            if last_date is None:
-                streak = 1
-            elif date == last_date:
-                pass
-            elif date == last_date + datetime.timedelta(days=1):
-                streak += 1
-            else:
-                assert date > last_date
-                streak = 1
-            activity.streak = streak
-            last_date = date
-            activity_list.append(activity.to_dict())
 
-        return activity_list
+        content = exporter.join_records([fragments[row.run_id] for row in rows])
+        changed = exporter.write_if_changed(json_file, content, old_content)
+        if not changed:
+            print(f"{json_file} content unchanged, not rewritten")
+        self.session.merge(
+            ExportState(
+                json_file=json_key,
+                signature=signature,
+                exported_at=last_change,
+                row_count=len(rows),
+                content_hash=exporter.content_hash(content),
+            )
+        )
+        self.session.commit()
+        return changed
 
     def get_old_tracks_ids(self):
         try:
-            activities = self.session.query(Activity).all()
-            return [str(a.run_id) for a in activities]
+            return {
+                str(run_id)
+                for (run_id,) in self.session.execute(select(Activity.run_id))
+            }
         except Exception as e:
             # pass the error
             print(f"something wrong with {str(e)}")
-            return []
+            return set()
+
+    def sync_state(self, source, activity_source=None, id_prefix=None):
+        return SourceSyncState(self.session, source, activity_source, id_prefix)
+
+    def manifest(self, folder):
+        return DirectoryManifest(folder, self.session)
@@ -1,14 +1,34 @@
 import datetime
+import functools
 import random
 import string
 import time
+import zlib
+from collections import Counter, namedtuple
 
 import geopy
-from config import TYPE_DICT
+import s2sphere as s2
+from config import MAPPING_TYPE, TYPE_DICT, config
 from geopy.geocoders import Nominatim
-from sqlalchemy import Column, Float, Integer, Interval, String, create_engine
+from sqlalchemy import (
+    Column,
+    Float,
+    ForeignKey,
+    Integer,
+    Interval,
+    LargeBinary,
+    String,
+    delete,
+    func,
+    select,
+    type_coerce,
+)
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import relationship, sessionmaker
+
+from .migrations import is_current, migrate
+from .storage import create_storage_engine, writer_lock
 
 Base = declarative_base()
 
@@ -23,6 +43,20 @@ geopy.geocoders.options.default_user_agent = "my-application"
 # reverse the location (lan, lon) -> location detail
 g = Nominatim(user_agent=randomword())
 
+# reverse geocoding results are cached per S2 cell of the start point,
+# level 14 cells are about 600m wide
+GEOCODE_CACHE_LEVEL = config("geocode", "cache_level") or 14
+# seconds before a cached location is looked up again, 0 means never expire
+GEOCODE_CACHE_TTL = config("geocode", "cache_ttl") or 0
+
+# "nominatim" (default) or "offline" to resolve locations from a local
+# gazetteer file, see generator/offline_geocoder.py for the file format
+GEOCODE_BACKEND = config("geocode", "backend") or "nominatim"
+GEOCODE_GAZETTEER = config("geocode", "gazetteer")
+
+geocode_cache_stats = Counter()
+_offline_geocoder = None
+
 
 ACTIVITY_KEYS = [
     "run_id",
@@ -39,6 +73,117 @@ ACTIVITY_KEYS = [
     "source",
 ]
 
+# columns refreshed when an existing activity is synced again,
+# location and start dates are only written on creation
+UPDATE_KEYS = [
+    "name",
+    "distance",
+    "moving_time",
+    "elapsed_time",
+    "type",
+    "average_heartrate",
+    "average_speed",
+    "summary_polyline",
+    "source",
+]
+
+# polyline_simplifier settings stored with the polyline in activity_geometry
+GEOMETRY_KEYS = ["simplify_tolerance", "simplify_max_points"]
+
+# rows per INSERT ... ON CONFLICT statement in bulk_upsert_activities
+UPSERT_CHUNK_SIZE = 500
+
+# run_ids: the activities that are stored now, created, updated or unchanged
+UpsertStats = namedtuple("UpsertStats", "created updated unchanged run_ids")
+
+
+def compress_polyline(summary_polyline):
+    return zlib.compress(summary_polyline.encode(), 9) if summary_polyline else None
+
+
+def decompress_polyline(data):
+    return zlib.decompress(data).decode() if data else ""
+
+
+class ActivityGeometry(Base):
+    """Track geometry kept apart so metadata queries never read it."""
+
+    __tablename__ = "activity_geometry"
+
+    run_id = Column(
+        Integer,
+        ForeignKey("activities.run_id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    # zlib compressed summary polyline
+    polyline = Column(LargeBinary)
+    # metres and point cap the polyline was simplified with, see
+    # polyline_simplifier.py, NULL when it was stored as received
+    simplify_tolerance = Column(Float)
+    simplify_max_points = Column(Integer)
+
+
+class SyncState(Base):
+    """High-water mark of a sync provider, see generator/sync_state.py"""
+
+    __tablename__ = "sync_state"
+
+    source = Column(String, primary_key=True)
+    # provider specific, e.g. the start timestamp of the newest synced activity
+    cursor = Column(String)
+    synced_at = Column(Float)
+
+
+class SyncKnownId(Base):
+    """Remote activity ids a sync provider has already synced."""
+
+    __tablename__ = "sync_known_ids"
+
+    source = Column(String, primary_key=True)
+    remote_id = Column(String, primary_key=True)
+
+
+class DataFile(Base):
+    """A file of a data folder as last scanned, see generator/manifest.py"""
+
+    __tablename__ = "data_files"
+
+    # relative to the repository root, the same on every checkout
+    folder = Column(String, primary_key=True)
+    name = Column(String, primary_key=True)
+    size = Column(Integer)
+    mtime_ns = Column(Integer)
+    content_hash = Column(String)
+    # activity the file went into, NULL when that is not known
+    run_id = Column(Integer)
+    # time.time() of the import, NULL while the file is not imported
+    imported_at = Column(Float)
+
+
+class ExportState(Base):
+    """What was last written to an exported json file, see generator/exporter.py"""
+
+    __tablename__ = "export_state"
+
+    json_file = Column(String, primary_key=True)
+    # export mode and filter settings the file was written with
+    signature = Column(String)
+    # max Activity.updated_at included in the file
+    exported_at = Column(Float)
+    # number of activities in the file
+    row_count = Column(Integer)
+    content_hash = Column(String)
+
+
+class ActivityStreak(Base):
+    """Running streak per day for each kind of export, see STREAK_KINDS."""
+
+    __tablename__ = "activity_streaks"
+
+    kind = Column(String, primary_key=True)
+    date = Column(String, primary_key=True)
+    streak = Column(Integer)
+
 
 class Activity(Base):
     __tablename__ = "activities"
@@ -52,11 +197,29 @@ class Activity(Base):
     start_date = Column(String)
     start_date_local = Column(String)
     location_country = Column(String)
-    summary_polyline = Column(String)
+    # loaded on first access of summary_polyline only
+    geometry = relationship(
+        ActivityGeometry, uselist=False, lazy="select", cascade="all, delete-orphan"
+    )
     average_heartrate = Column(Float)
     average_speed = Column(Float)
     streak = None
     source = Column(String)
+    # time.time() of the last insert or change, drives incremental export
+    updated_at = Column(Float, index=True)
+
+    @property
+    def summary_polyline(self):
+        return decompress_polyline(self.geometry.polyline) if self.geometry else ""
+
+    @summary_polyline.setter
+    def summary_polyline(self, value):
+        if not value:
+            self.geometry = None
+        elif self.geometry:
+            self.geometry.polyline = compress_polyline(value)
+        else:
+            self.geometry = ActivityGeometry(polyline=compress_polyline(value))
 
     def to_dict(self):
         out = {}
@@ -73,70 +236,166 @@ class Activity(Base):
         return out
 
 
+class GeocodeCache(Base):
+    __tablename__ = "geocode_cache"
+
+    cell_token = Column(String, primary_key=True)
+    location_country = Column(String)
+    updated_at = Column(Integer)
+
+
+def geocode_cell_token(lat, lon, level=None):
+    cell = s2.CellId.from_lat_lng(s2.LatLng.from_degrees(lat, lon))
+    return cell.parent(level or GEOCODE_CACHE_LEVEL).to_token()
+
+
+def geocode_cache_hit_rate():
+    lookups = geocode_cache_stats["hit"] + geocode_cache_stats["miss"]
+    return geocode_cache_stats["hit"] / lookups if lookups else 0
+
+
+def _nominatim_reverse(lat, lon):
+    try:
+        return str(g.reverse(f"{lat}, {lon}", language="zh-CN"))
+    # limit (only for the first time)
+    except Exception as e:
+        try:
+            return str(g.reverse(f"{lat}, {lon}", language="zh-CN"))
+        except Exception as e:
+            return None
+
+
+def cached_reverse_geocode(session, lat, lon):
+    """
+    Reverse geocode (lat, lon) through the geocode_cache table.
+    Only cache misses and expired entries go to Nominatim,
+    failed lookups are not cached so they are retried on the next sync.
+    """
+    token = geocode_cell_token(lat, lon)
+    now = int(time.time())
+    cached = session.get(GeocodeCache, token)
+    if cached and (
+        not GEOCODE_CACHE_TTL or now - cached.updated_at < GEOCODE_CACHE_TTL
+    ):
+        geocode_cache_stats["hit"] += 1
+        return cached.location_country
+
+    geocode_cache_stats["miss"] += 1
+    location_country = _nominatim_reverse(lat, lon)
+    if location_country is None:
+        return cached.location_country if cached else None
+    session.merge(
+        GeocodeCache(
+            cell_token=token, location_country=location_country, updated_at=now
+        )
+    )
+    return location_country
+
+
+def offline_reverse_geocode(lat, lon):
+    global _offline_geocoder
+    if _offline_geocoder is None:
+        from .offline_geocoder import OfflineGeocoder
+
+        if not GEOCODE_GAZETTEER:
+            raise ValueError(
+                "geocode.backend is offline but geocode.gazetteer is not set, "
+                "set it to a gazetteer file or use the nominatim backend"
+            )
+        _offline_geocoder = OfflineGeocoder.from_file(GEOCODE_GAZETTEER)
+    return _offline_geocoder.reverse(lat, lon)
+
+
+def reverse_geocode(session, lat, lon):
+    if GEOCODE_BACKEND == "offline":
+        return offline_reverse_geocode(lat, lon)
+    return cached_reverse_geocode(session, lat, lon)
+
+
+def _reverse_location_country(session, run_activity):
+    start_point = run_activity.start_latlng
+    location_country = getattr(run_activity, "location_country", "")
+    # or China for #176 to fix
+    if not start_point:
+        return location_country
+    if not location_country or location_country == "China":
+        location_country = (
+            reverse_geocode(session, start_point.lat, start_point.lon)
+            or location_country
+        )
+    return location_country
+
+
+def activity_day(start_date_local):
+    """YYYY-MM-DD of a start_date_local given as a string or a datetime."""
+    if isinstance(start_date_local, datetime.date):
+        return start_date_local.strftime("%Y-%m-%d")
+    return str(start_date_local)[:10]
+
+
+def _activity_values(run_activity):
+    type = run_activity.type
+    if run_activity.type in TYPE_DICT:
+        type = TYPE_DICT[run_activity.type]
+    return {
+        "run_id": int(run_activity.id),
+        "name": run_activity.name,
+        "distance": float(run_activity.distance),
+        "moving_time": run_activity.moving_time,
+        "elapsed_time": run_activity.elapsed_time,
+        "type": type,
+        "start_date": run_activity.start_date,
+        "start_date_local": run_activity.start_date_local,
+        "average_heartrate": run_activity.average_heartrate,
+        "average_speed": float(run_activity.average_speed),
+        "summary_polyline": (
+            run_activity.map and run_activity.map.summary_polyline or ""
+        ),
+        # only run_map has these, not the maps of stravalib activities
+        "simplify_tolerance": getattr(run_activity.map, "simplify_tolerance", None),
+        "simplify_max_points": getattr(run_activity.map, "simplify_max_points", None),
+        "source": run_activity.source if hasattr(run_activity, "source") else "gpx",
+    }
+
+
+def _fingerprint(values):
+    return tuple(values[key] for key in UPDATE_KEYS)
+
+
+def _set_geometry_values(activity, geometry_values):
+    if activity.geometry:
+        for key, value in geometry_values.items():
+            setattr(activity.geometry, key, value)
+
+
 def update_or_create_activity(session, run_activity):
     created = False
     try:
         activity = (
             session.query(Activity).filter_by(run_id=int(run_activity.id)).first()
         )
-        type = run_activity.type
-        source = run_activity.source if hasattr(run_activity, "source") else "gpx"
-        if run_activity.type in TYPE_DICT:
-            type = TYPE_DICT[run_activity.type]
+        values = _activity_values(run_activity)
+        geometry_values = {key: values.pop(key) for key in GEOMETRY_KEYS}
         if not activity:
-            start_point = run_activity.start_latlng
-            location_country = getattr(run_activity, "location_country", "")
-            # or China for #176 to fix
-            if not location_country and start_point or location_country == "China":
-                try:
-                    location_country = str(
-                        g.reverse(
-                            f"{start_point.lat}, {start_point.lon}", language="zh-CN"
-                        )
-                    )
-                # limit (only for the first time)
-                except Exception as e:
-                    try:
-                        location_country = str(
-                            g.reverse(
-                                f"{start_point.lat}, {start_point.lon}",
-                                language="zh-CN",
-                            )
-                        )
-                    except Exception as e:
-                        pass
-
             activity = Activity(
-                run_id=run_activity.id,
-                name=run_activity.name,
-                distance=run_activity.distance,
-                moving_time=run_activity.moving_time,
-                elapsed_time=run_activity.elapsed_time,
-                type=type,
-                start_date=run_activity.start_date,
-                start_date_local=run_activity.start_date_local,
-                location_country=location_country,
-                average_heartrate=run_activity.average_heartrate,
-                average_speed=float(run_activity.average_speed),
-                summary_polyline=(
-                    run_activity.map and run_activity.map.summary_polyline or ""
-                ),
-                source=source,
+                location_country=_reverse_location_country(session, run_activity),
+                updated_at=time.time(),
+                **values,
             )
+            _set_geometry_values(activity, geometry_values)
             session.add(activity)
+            session.flush()
+            refresh_streaks(session, since=activity_day(activity.start_date_local))
             created = True
-        else:
-            activity.name = run_activity.name
-            activity.distance = float(run_activity.distance)
-            activity.moving_time = run_activity.moving_time
-            activity.elapsed_time = run_activity.elapsed_time
-            activity.type = type
-            activity.average_heartrate = run_activity.average_heartrate
-            activity.average_speed = float(run_activity.average_speed)
-            activity.summary_polyline = (
-                run_activity.map and run_activity.map.summary_polyline or ""
-            )
-            activity.source = source
+        elif _fingerprint(
+            {key: getattr(activity, key) for key in UPDATE_KEYS}
+        ) != _fingerprint(values):
+            for key in UPDATE_KEYS:
+                setattr(activity, key, values[key])
+            _set_geometry_values(activity, geometry_values)
+            activity.updated_at = time.time()
+            session.flush()
+            refresh_streaks(session, since=activity_day(activity.start_date_local))
     except Exception as e:
         print(f"something wrong with {run_activity.id}")
         print(str(e))
@@ -144,10 +403,282 @@ def update_or_create_activity(session, run_activity):
     return created
 
 
-def init_db(db_path):
-    engine = create_engine(
-        f"sqlite:///{db_path}", connect_args={"check_same_thread": False}
-    )
-    Base.metadata.create_all(engine)
+def _stored_column(key):
+    if key == "summary_polyline":
+        return ActivityGeometry.polyline
+    return getattr(Activity, key)
+
+
+def _upsert_chunk(session, chunk, on_progress, affected_dates):
+    run_ids = [values["run_id"] for _, values in chunk]
+    polyline_index = UPDATE_KEYS.index("summary_polyline")
+    existing = {}
+    stored_dates = {}
+    for row in session.execute(
+        select(
+            Activity.run_id,
+            Activity.start_date_local,
+            *[_stored_column(key) for key in UPDATE_KEYS],
+        )
+        .outerjoin(ActivityGeometry)
+        .where(Activity.run_id.in_(run_ids))
+    ):
+        old = list(row[2:])
+        old[polyline_index] = decompress_polyline(old[polyline_index])
+        existing[row[0]] = tuple(old)
+        stored_dates[row[0]] = row[1]
+    rows = {}
+    now = time.time()
+    created = updated = unchanged = 0
+    for run_activity, values in chunk:
+        old = existing.get(values["run_id"])
+        if old is None:
+            values["location_country"] = _reverse_location_country(
+                session, run_activity
+            )
+            existing[values["run_id"]] = _fingerprint(values)
+            created += 1
+            status = "created"
+        elif old == _fingerprint(values):
+            unchanged += 1
+            status = "unchanged"
+        else:
+            existing[values["run_id"]] = _fingerprint(values)
+            updated += 1
+            status = "updated"
+        if status != "unchanged":
+            affected_dates.add(
+                activity_day(
+                    stored_dates.get(values["run_id"], values["start_date_local"])
+                )
+            )
+            # the same run_id may show up twice in one chunk, last one wins
+            values["updated_at"] = now
+            rows.setdefault(values["run_id"], {}).update(values)
+        if on_progress:
+            on_progress(status)
+
+    if rows:
+        activity_rows = []
+        geometry_rows = []
+        no_geometry = []
+        for values in rows.values():
+            values.setdefault("location_country", "")
+            summary_polyline = values.pop("summary_polyline")
+            geometry_values = {key: values.pop(key) for key in GEOMETRY_KEYS}
+            activity_rows.append(values)
+            if summary_polyline:
+                geometry_rows.append(
+                    {
+                        "run_id": values["run_id"],
+                        "polyline": compress_polyline(summary_polyline),
+                        **geometry_values,
+                    }
+                )
+            else:
+                no_geometry.append(values["run_id"])
+
+        stmt = insert(Activity)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Activity.run_id],
+            set_={
+                key: getattr(stmt.excluded, key)
+                for key in UPDATE_KEYS + ["updated_at"]
+                if key != "summary_polyline"
+            },
+        )
+        session.execute(stmt, activity_rows)
+        if geometry_rows:
+            stmt = insert(ActivityGeometry)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[ActivityGeometry.run_id],
+                set_={
+                    key: getattr(stmt.excluded, key)
+                    for key in ["polyline"] + GEOMETRY_KEYS
+                },
+            )
+            session.execute(stmt, geometry_rows)
+        if no_geometry:
+            session.execute(
+                delete(ActivityGeometry).where(ActivityGeometry.run_id.in_(no_geometry))
+            )
+    return UpsertStats(created, updated, unchanged, run_ids)
+
+
+def bulk_upsert_activities(
+    session, run_activities, chunk_size=UPSERT_CHUNK_SIZE, on_progress=None
+):
+    """
+    Insert or update many activities with one INSERT ... ON CONFLICT per chunk.
+
+    Rows whose content matches what is already stored are skipped, so re-syncing
+    unchanged activities writes nothing. `on_progress` is called once per
+    activity with "created", "updated" or "unchanged".
+    Streaks are refreshed from the earliest day that was written.
+    Returns UpsertStats with the counts and the run_ids, activities that
+    could not be read are in neither.
+    """
+    created = updated = unchanged = 0
+    run_ids = []
+    chunk = []
+    affected_dates = set()
+
+    def flush():
+        nonlocal created, updated, unchanged
+        stats = _upsert_chunk(session, chunk, on_progress, affected_dates)
+        created += stats.created
+        updated += stats.updated
+        unchanged += stats.unchanged
+        run_ids.extend(stats.run_ids)
+        chunk.clear()
+
+    for run_activity in run_activities:
+        if not run_activity:
+            continue
+        try:
+            chunk.append((run_activity, _activity_values(run_activity)))
+        except Exception as e:
+            print(f"something wrong with {run_activity.id}")
+            print(str(e))
+            continue
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+    if affected_dates:
+        refresh_streaks(session, since=min(affected_dates))
+
+    return UpsertStats(created, updated, unchanged, run_ids)
+
+
+def delete_activities(session, run_ids):
+    """
+    Delete the activities with run_ids and their geometry, and refresh the
+    streaks from the earliest day of them. Returns the number deleted.
+    """
+    run_ids = list(run_ids)
+    dates = []
+    for i in range(0, len(run_ids), UPSERT_CHUNK_SIZE):
+        chunk = run_ids[i : i + UPSERT_CHUNK_SIZE]
+        dates.extend(
+            activity_day(start_date_local)
+            for (start_date_local,) in session.execute(
+                select(Activity.start_date_local).where(Activity.run_id.in_(chunk))
+            )
+        )
+        session.execute(
+            delete(ActivityGeometry).where(ActivityGeometry.run_id.in_(chunk))
+        )
+        session.execute(delete(Activity).where(Activity.run_id.in_(chunk)))
+    if dates:
+        refresh_streaks(session, since=min(dates))
+    return len(dates)
+
+
+# activities counted in each streak, "all" and "run" are Generator.load()
+# without and with only_run, "mapping" is Generator.loadForMapping()
+STREAK_KINDS = ["all", "run", "mapping"]
+
+
+def streak_criteria(kind):
+    if kind == "mapping":
+        return [Activity.type.in_(MAPPING_TYPE)]
+    if kind == "run":
+        return [Activity.distance > 0.1, Activity.type == "Run"]
+    return [Activity.distance > 0.1]
+
+
+def refresh_streaks(conn, since=None):
+    """
+    Recompute activity_streaks from the day `since` (YYYY-MM-DD) forward,
+    or for the whole history when it is None. conn is a Session or Connection.
+    """
+    day = func.substr(Activity.start_date_local, 1, 10)
+    for kind in STREAK_KINDS:
+        days = select(day).distinct().where(*streak_criteria(kind)).order_by(day)
+        stale = delete(ActivityStreak).where(ActivityStreak.kind == kind)
+        streak, last_date = 0, None
+        if since:
+            days = days.where(day >= since)
+            stale = stale.where(ActivityStreak.date >= since)
+            previous = conn.execute(
+                select(ActivityStreak.date, ActivityStreak.streak)
+                .where(ActivityStreak.kind == kind, ActivityStreak.date < since)
+                .order_by(ActivityStreak.date.desc())
+                .limit(1)
+            ).first()
+            if previous:
+                streak = previous.streak
+                last_date = datetime.date.fromisoformat(previous.date)
+        rows = []
+        for (start_day,) in conn.execute(days):
+            date = datetime.date.fromisoformat(start_day)
+            if last_date is not None and date == last_date + datetime.timedelta(days=1):
+                streak += 1
+            else:
+                streak = 1
+            last_date = date
+            rows.append({"kind": kind, "date": start_day, "streak": streak})
+        conn.execute(stale)
+        if rows:
+            conn.execute(insert(ActivityStreak), rows)
+
+
+INTERVAL_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+@functools.lru_cache(maxsize=None)
+def _format_interval(stored):
+    # Interval is stored as epoch + delta on SQLite, format it as str(timedelta)
+    return str(datetime.datetime.fromisoformat(stored) - INTERVAL_EPOCH)
+
+
+def iter_activity_rows(session, *criteria, streak_kind=None, chunk_size=1000):
+    """
+    Stream activities as plain tuples in ACTIVITY_KEYS order, without building
+    ORM objects. Values are already in their exported form: intervals are
+    formatted like str(timedelta) and the polyline is decompressed.
+    With streak_kind the stored streak of that kind is appended to each row.
+    """
+    columns = []
+    for key in ACTIVITY_KEYS:
+        column = _stored_column(key)
+        if isinstance(column.type, Interval):
+            # read the stored text, skipping the per row Interval conversion
+            column = type_coerce(column, String)
+        columns.append(column)
+    interval_indexes = [
+        i
+        for i, key in enumerate(ACTIVITY_KEYS)
+        if isinstance(_stored_column(key).type, Interval)
+    ]
+    polyline_index = ACTIVITY_KEYS.index("summary_polyline")
+    stmt = select(*columns).outerjoin(ActivityGeometry)
+    if streak_kind:
+        stmt = stmt.add_columns(ActivityStreak.streak).outerjoin(
+            ActivityStreak,
+            (ActivityStreak.kind == streak_kind)
+            & (ActivityStreak.date == func.substr(Activity.start_date_local, 1, 10)),
+        )
+    stmt = stmt.where(*criteria).order_by(Activity.start_date_local)
+    result = session.execute(stmt.execution_options(stream_results=True))
+    for partition in result.partitions(chunk_size):
+        for row in partition:
+            row = list(row)
+            for i in interval_indexes:
+                if row[i] is not None:
+                    row[i] = _format_interval(row[i])
+            row[polyline_index] = decompress_polyline(row[polyline_index])
+            yield row
+
+
+def init_db(db_path, profile=None):
+    engine = create_storage_engine(db_path, profile)
+    if not is_current(engine, Base.metadata):
+        # readers like the poster render must not migrate or VACUUM data.db
+        # under a running sync
+        with writer_lock(db_path):
+            Base.metadata.create_all(engine)
+            migrate(engine)
     session = sessionmaker(bind=engine)
     return session()
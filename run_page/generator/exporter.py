@@ -0,0 +1,84 @@
+"""
+Helpers for the incremental activities.json export in Generator.export_json.
+
+The file is written exactly like json.dump(activities, f, indent=0), so the
+text of every record can be cut out of the previous file and reused as is
+when the activity has not changed since that export.
+"""
+
+import hashlib
+import json
+import os
+import stat
+import tempfile
+
+RECORD_SEPARATOR = ",\n"
+
+
+def content_hash(content):
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def read_json_file(json_file):
+    try:
+        with open(json_file, encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def serialize_record(activity):
+    # same text json.dump(list, indent=0) writes for one element
+    return json.dumps(activity, indent=0)
+
+
+def join_records(fragments):
+    if not fragments:
+        return "[]"
+    return "[\n" + RECORD_SEPARATOR.join(fragments) + "\n]"
+
+
+def split_records(content):
+    """
+    Cut a previously exported file into {run_id: (streak, record text)}.
+    Returns None if the file is not a list of activity records.
+    """
+    decoder = json.JSONDecoder()
+    records = {}
+    try:
+        index = content.index("[") + 1
+        while True:
+            while content[index].isspace():
+                index += 1
+            if content[index] == "]":
+                return records
+            record, end = decoder.raw_decode(content, index)
+            records[record["run_id"]] = (record.get("streak"), content[index:end])
+            index = end
+            while content[index].isspace():
+                index += 1
+            if content[index] == ",":
+                index += 1
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+def write_if_changed(json_file, content, old_content=None):
+    """Atomically replace json_file with content, unless it is already equal."""
+    if old_content is None:
+        old_content = read_json_file(json_file)
+    if old_content is not None and content_hash(old_content) == content_hash(content):
+        return False
+    directory = os.path.dirname(os.path.abspath(json_file))
+    mode = os.stat(json_file).st_mode if os.path.exists(json_file) else 0o644
+    fd, tmp_file = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+        # mkstemp creates the file private to the user
+        os.chmod(tmp_file, stat.S_IMODE(mode))
+        os.replace(tmp_file, json_file)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+    return True
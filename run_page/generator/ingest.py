@@ -0,0 +1,220 @@
+"""
+Streaming import of GPX/TCX/FIT files into data.db.
+
+    stats = ingest_files(
+        session, loader, manifest.to_import(diff), "gpx", diff.replaced
+    )
+    manifest.mark_imported(stats.imported)
+
+    files -> cache / parse pool -> filter -> merge keys
+    after the last file: merge groups -> cache -> merge -> queue -> writer thread
+                                                         (batched upsert,
+                                                          commit every
+                                                          COMMIT_EVERY)
+
+The stages are generators and one bounded queue.Queue, so what is in memory
+is the parse chunks in flight, a small MergeKey per track, then the tracks
+of one chunk of groups, the queue and one upsert batch. The track cache is
+committed as the run goes, so an interrupted run only parses what was not
+cached yet.
+
+Tracks within an hour of each other are merged like TrackLoader.load_tracks()
+does. Files come in no particular order, so nothing is written before the
+last file is loaded. Then the tracks of every group are loaded again from
+the track cache, about UPSERT_CHUNK_SIZE files at a time, and written as one
+activity under the run_id of the first track. The later tracks of a group
+are never written or geocoded on their own. Without a track cache every
+file is parsed twice.
+
+When a file of a merged group changes, the manifest lists the other files
+of the group again and the run_id the group was written to is passed as
+replaced_ids, so the group is merged again from all of its files and a row
+no group owns anymore is deleted. Deleting a file keeps its activity.
+"""
+
+import queue
+import threading
+import time
+from collections import namedtuple
+
+from .db import UPSERT_CHUNK_SIZE, bulk_upsert_activities, delete_activities
+
+# activities written between two commits of data.db
+COMMIT_EVERY = 1000
+# activities waiting for the writer thread
+QUEUE_SIZE = 2 * UPSERT_CHUNK_SIZE
+# seconds between two progress lines
+PROGRESS_INTERVAL = 5
+
+# what is kept of every imported track to merge it after the last file
+MergeKey = namedtuple(
+    "MergeKey", "start_time_local end_time_local type run_id length file_name"
+)
+
+
+class IngestStats:
+    """Counts of the pipeline stages and the files that were imported."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.reported = self.started
+        self.loaded = 0
+        self.skipped = 0
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.merged = 0
+        self.deleted = 0
+        # file name: run_id of the activity it was imported into
+        self.imported = {}
+
+    def count(self, status):
+        """on_progress of bulk_upsert_activities, called by the writer thread."""
+        setattr(self, status, getattr(self, status) + 1)
+
+    def report(self, force=False):
+        """Print a progress line, at most every PROGRESS_INTERVAL seconds."""
+        now = time.time()
+        if not force and now - self.reported < PROGRESS_INTERVAL:
+            return
+        self.reported = now
+        rate = self.loaded / max(now - self.started, 1e-6)
+        print(
+            f"{self.loaded} files loaded ({rate:.1f}/s), {self.skipped} skipped, "
+            f"{self.created} created, {self.updated} updated, "
+            f"{self.unchanged} unchanged",
+            flush=True,
+        )
+
+
+class ActivityWriter(threading.Thread):
+    """
+    Upserts the activities put() into it in batches of batch_size on its own
+    thread, committing every commit_every activities and when closed.
+    """
+
+    def __init__(
+        self, session, stats, batch_size=UPSERT_CHUNK_SIZE, commit_every=COMMIT_EVERY
+    ):
+        super().__init__(name="activity-writer", daemon=True)
+        self.session = session
+        self.stats = stats
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.error = None
+
+    def put(self, run_activity):
+        """Queue run_activity, waiting while the queue is full."""
+        while self.is_alive():
+            try:
+                self.queue.put(run_activity, timeout=1)
+                return
+            except queue.Full:
+                continue
+        # the writer failed, nothing would take the activity
+        self.close()
+
+    def close(self):
+        """Write and commit what is queued, then raise what the writer raised."""
+        if self.is_alive():
+            self.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        batch = []
+        uncommitted = 0
+        try:
+            while True:
+                run_activity = self.queue.get()
+                if run_activity is not None:
+                    batch.append(run_activity)
+                if batch and (run_activity is None or len(batch) >= self.batch_size):
+                    bulk_upsert_activities(
+                        self.session, batch, on_progress=self.stats.count
+                    )
+                    uncommitted += len(batch)
+                    batch = []
+                if uncommitted and (
+                    run_activity is None or uncommitted >= self.commit_every
+                ):
+                    self.session.commit()
+                    uncommitted = 0
+                if run_activity is None:
+                    return
+        except Exception as e:
+            self.session.rollback()
+            self.error = e
+
+
+def ingest_files(session, loader, file_names, file_suffix, replaced_ids=()):
+    """
+    Import file_names with loader, a TrackLoader, into session, and delete
+    the activities of replaced_ids that none of the files is written to.
+    Returns the IngestStats of the run.
+    """
+    stats = IngestStats()
+    keys = []
+    for file_name, t in loader.iter_tracks(file_names, file_suffix):
+        stats.loaded += 1
+        if not loader.keep_track(t):
+            stats.skipped += 1
+        else:
+            keys.append(
+                MergeKey(
+                    t.start_time_local,
+                    t.end_time_local,
+                    t.type,
+                    t.run_id,
+                    t.length,
+                    file_name,
+                )
+            )
+        stats.report()
+    groups = [
+        group
+        for group in loader.merge_groups(keys)
+        # Track.merge() adds up the lengths
+        if sum(k.length for k in group) >= loader.min_length
+    ]
+    # nothing of an earlier query may hold the database while the writer runs
+    session.commit()
+    writer = ActivityWriter(session, stats)
+    writer.start()
+    try:
+        for t in _merged_tracks(loader, groups, file_suffix, stats):
+            writer.put(t.to_namedtuple())
+    finally:
+        writer.close()
+    # a group written under a replaced run_id again keeps the row
+    kept_ids = {group[0].run_id for group in groups}
+    stats.deleted = delete_activities(session, set(replaced_ids) - kept_ids)
+    session.commit()
+    stats.report(force=True)
+    return stats
+
+
+def _merged_tracks(loader, groups, file_suffix, stats):
+    """
+    Yield one track per group of MergeKeys, the tracks of its files merged,
+    loading about UPSERT_CHUNK_SIZE files from the track cache at a time.
+    """
+    chunk, chunk_files = [], 0
+    for i, group in enumerate(groups):
+        chunk.append(group)
+        chunk_files += len(group)
+        if chunk_files < UPSERT_CHUNK_SIZE and i < len(groups) - 1:
+            continue
+        tracks = iter(
+            loader.reload_tracks([k.file_name for g in chunk for k in g], file_suffix)
+        )
+        for members in chunk:
+            stats.imported.update((k.file_name, members[0].run_id) for k in members)
+            merged = next(tracks)
+            if len(members) > 1:
+                merged.merge([next(tracks) for _ in members[1:]])
+                stats.merged += 1
+            yield merged
+        chunk, chunk_files = [], 0
@@ -0,0 +1,217 @@
+"""
+The files of a data folder (GPX_OUT, TCX_OUT, FIT_OUT, ...) read with one
+os.scandir pass, and what data.db remembers of them.
+
+    # the ids of the files already downloaded
+    downloaded_ids = DirectoryManifest(GPX_FOLDER).ids()
+
+    # what changed since the last import
+    manifest = generator.manifest(GPX_FOLDER)
+    diff = manifest.diff("gpx")
+    file_names = manifest.to_import(diff)
+    ...
+    manifest.mark_imported({file_name: run_id})
+    manifest.save()
+
+Entries are kept per folder and file name in the data_files table. A file is
+unchanged when its size and mtime match the entry, or, after a checkout
+touched every mtime, when its content hash does, so only new files and files
+that look changed are read. Until a folder has entries, the names listed in
+imported.json count as imported.
+"""
+
+import os
+import time
+from collections import namedtuple
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.sqlite import insert
+
+from synced_data_file_logger import load_synced_file_list
+
+from .db import DataFile
+from .track_cache import file_hash
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# names per DELETE ... IN query
+DELETE_CHUNK_SIZE = 500
+
+# sorted file names of each state and the run_ids the changed files were
+# imported into, see DirectoryManifest.diff()
+ManifestDiff = namedtuple("ManifestDiff", "new changed deleted unchanged replaced")
+
+ENTRY_KEYS = ["size", "mtime_ns", "content_hash", "run_id", "imported_at"]
+
+
+class DirectoryManifest:
+    """
+    Attributes:
+        folder: absolute path of the data folder
+        session: data.db session the entries are kept in, None to only scan
+        files: file name: dict of ENTRY_KEYS as of the last diff()
+
+    Methods:
+        names: names of the files in the folder
+        ids: the names without extension
+        diff: the new, changed, deleted and unchanged files since the last scan
+            and the activities the changed ones went into
+        to_import: paths of the files that are not imported as they are now
+        hashes: size, mtime and content hash of the files, for TrackCache
+        mark_imported: remember the activities files were imported into
+        save: write the entries to data.db
+    """
+
+    def __init__(self, folder, session=None):
+        self.folder = os.path.abspath(folder)
+        self.session = session
+        self.key = os.path.relpath(self.folder, ROOT)
+        self.files = {}
+        self.dirty = set()
+        self.removed = set()
+        if session is not None:
+            rows = session.execute(
+                select(
+                    DataFile.name, *[getattr(DataFile, k) for k in ENTRY_KEYS]
+                ).where(DataFile.folder == self.key)
+            )
+            self.files = {row[0]: dict(zip(ENTRY_KEYS, row[1:])) for row in rows}
+
+    def scan(self, file_suffix=None):
+        """name: os.DirEntry of the files in the folder but dot files."""
+        entries = {}
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                if file_suffix and not entry.name.endswith(f".{file_suffix}"):
+                    continue
+                entries[entry.name] = entry
+        return entries
+
+    def names(self, file_suffix=None):
+        return sorted(self.scan(file_suffix))
+
+    def ids(self, file_suffix=None):
+        """Names up to the first dot, the activity ids of downloaded files."""
+        return {name.split(".")[0] for name in self.scan(file_suffix)}
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def __len__(self):
+        return len(self.files)
+
+    def diff(self, file_suffix=None):
+        """
+        Compare the folder with the entries and update them, returns the
+        ManifestDiff. A changed file is no longer imported, the activities
+        changed files went into are in ManifestDiff.replaced. Only the entry
+        of a deleted file goes, data.db keeps its activity.
+        """
+        entries = self.scan(file_suffix)
+        # imported before there was a manifest
+        imported = set(load_synced_file_list()) if not self.files else set()
+        now = time.time()
+        new, changed, unchanged = [], [], []
+        replaced = set()
+        for name in sorted(entries):
+            entry = entries[name]
+            stat = entry.stat()
+            known = self.files.get(name)
+            if known and (known["size"], known["mtime_ns"]) == (
+                stat.st_size,
+                stat.st_mtime_ns,
+            ):
+                unchanged.append(name)
+                continue
+            content_hash = file_hash(entry.path)
+            if known is None:
+                known = self.files[name] = {
+                    "content_hash": content_hash,
+                    "run_id": None,
+                    "imported_at": now if name in imported else None,
+                }
+                new.append(name)
+            elif known["content_hash"] == content_hash:
+                # only touched
+                unchanged.append(name)
+            else:
+                replaced.add(known["run_id"])
+                known.update(content_hash=content_hash, run_id=None, imported_at=None)
+                changed.append(name)
+            known.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            self.dirty.add(name)
+        deleted = sorted(
+            name
+            for name in self.files
+            if name not in entries
+            and (not file_suffix or name.endswith(f".{file_suffix}"))
+        )
+        for name in deleted:
+            del self.files[name]
+            self.dirty.discard(name)
+            self.removed.add(name)
+        replaced.discard(None)
+        return ManifestDiff(new, changed, deleted, unchanged, sorted(replaced))
+
+    def to_import(self, diff):
+        """
+        Paths of the files of diff that are not imported as they are now, and
+        of the files that went into the same activities as diff.replaced, so
+        those activities are merged again from what is left of them.
+        """
+        replaced = set(diff.replaced)
+        return [
+            os.path.join(self.folder, name)
+            for name in sorted(diff.new + diff.changed + diff.unchanged)
+            if self.files[name]["imported_at"] is None
+            or self.files[name]["run_id"] in replaced
+        ]
+
+    def hashes(self):
+        """{path: (size, mtime_ns, content hash)} of the entries, for TrackCache."""
+        return {
+            os.path.join(self.folder, name): (
+                entry["size"],
+                entry["mtime_ns"],
+                entry["content_hash"],
+            )
+            for name, entry in self.files.items()
+            if entry["content_hash"]
+        }
+
+    def mark_imported(self, run_ids):
+        """Record {file name or path: run_id of its activity} as imported."""
+        now = time.time()
+        for file_name, run_id in run_ids.items():
+            name = os.path.basename(file_name)
+            self.files[name].update(run_id=run_id, imported_at=now)
+            self.dirty.add(name)
+
+    def save(self):
+        if self.session is None:
+            return
+        if self.dirty:
+            stmt = insert(DataFile)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[DataFile.folder, DataFile.name],
+                set_={key: getattr(stmt.excluded, key) for key in ENTRY_KEYS},
+            )
+            self.session.execute(
+                stmt,
+                [
+                    {"folder": self.key, "name": name, **self.files[name]}
+                    for name in self.dirty
+                ],
+            )
+            self.dirty = set()
+        removed = sorted(self.removed)
+        for i in range(0, len(removed), DELETE_CHUNK_SIZE):
+            self.session.execute(
+                delete(DataFile).where(
+                    DataFile.folder == self.key,
+                    DataFile.name.in_(removed[i : i + DELETE_CHUNK_SIZE]),
+                )
+            )
+        self.removed = set()
+        self.session.commit()
@@ -0,0 +1,171 @@
+"""
+Versioned schema migrations for data.db.
+
+Base.metadata.create_all only creates missing tables, it never changes the
+tables of a database that is already committed to the repo. Every change to
+an existing table goes into MIGRATIONS instead, in order. The version of a
+database is kept in the schema_version table and only the steps after it are
+run, each in its own transaction.
+
+Steps must also work on a database freshly created from the current models,
+so use the helpers below (IF NOT EXISTS, column checks) instead of bare DDL.
+"""
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(text(f"PRAGMA table_info({table})"))}
+
+
+def add_column(conn, table, column, ddl):
+    if column not in _columns(conn, table):
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def create_index(conn, name, table, columns):
+    conn.execute(
+        text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+    )
+
+
+def _add_activity_indexes(conn):
+    create_index(
+        conn, "ix_activities_start_date_local", "activities", ["start_date_local"]
+    )
+    create_index(
+        conn,
+        "ix_activities_type_start_date_local",
+        "activities",
+        ["type", "start_date_local"],
+    )
+    create_index(conn, "ix_activities_source", "activities", ["source"])
+
+
+def _move_polyline_to_geometry(conn):
+    from .db import compress_polyline
+
+    if "summary_polyline" not in _columns(conn, "activities"):
+        return
+    conn.execute(
+        text(
+            "CREATE TABLE IF NOT EXISTS activity_geometry ("
+            "run_id INTEGER NOT NULL PRIMARY KEY "
+            "REFERENCES activities (run_id) ON DELETE CASCADE, "
+            "polyline BLOB)"
+        )
+    )
+    rows = conn.execute(
+        text(
+            "SELECT run_id, summary_polyline FROM activities "
+            "WHERE summary_polyline IS NOT NULL AND summary_polyline != ''"
+        )
+    )
+    geometry = [
+        {"run_id": run_id, "polyline": compress_polyline(summary_polyline)}
+        for run_id, summary_polyline in rows
+    ]
+    if geometry:
+        conn.execute(
+            text(
+                "INSERT OR REPLACE INTO activity_geometry (run_id, polyline) "
+                "VALUES (:run_id, :polyline)"
+            ),
+            geometry,
+        )
+    try:
+        conn.execute(text("ALTER TABLE activities DROP COLUMN summary_polyline"))
+    except OperationalError:
+        # DROP COLUMN needs SQLite 3.35+, just empty the column on older ones
+        conn.execute(text("UPDATE activities SET summary_polyline = NULL"))
+
+
+def _add_updated_at(conn):
+    add_column(conn, "activities", "updated_at", "FLOAT")
+    create_index(conn, "ix_activities_updated_at", "activities", ["updated_at"])
+
+
+def _fill_streaks(conn):
+    from .db import ActivityStreak, refresh_streaks
+
+    ActivityStreak.__table__.create(conn, checkfirst=True)
+    refresh_streaks(conn)
+
+
+def _add_simplify_settings(conn):
+    add_column(conn, "activity_geometry", "simplify_tolerance", "FLOAT")
+    add_column(conn, "activity_geometry", "simplify_max_points", "INTEGER")
+
+
+def _add_export_row_count(conn):
+    add_column(conn, "export_state", "row_count", "INTEGER")
+
+
+# (version, description, step), append new steps at the end
+MIGRATIONS = [
+    (
+        1,
+        "index activities on start_date_local, (type, start_date_local), source",
+        _add_activity_indexes,
+    ),
+    (
+        2,
+        "move summary_polyline into the compressed activity_geometry table",
+        _move_polyline_to_geometry,
+    ),
+    (3, "add activities.updated_at for incremental export", _add_updated_at),
+    (4, "precompute running streaks into activity_streaks", _fill_streaks),
+    (
+        5,
+        "record the polyline simplification settings in activity_geometry",
+        _add_simplify_settings,
+    ),
+    (
+        6,
+        "add export_state.row_count to notice deleted activities",
+        _add_export_row_count,
+    ),
+]
+
+
+def get_schema_version(conn):
+    conn.execute(
+        text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    )
+    version = conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar()
+    return version or 0
+
+
+def is_current(engine, metadata):
+    """Whether every table of metadata exists and every step ran, read only."""
+    with engine.connect() as conn:
+        tables = set(inspect(conn).get_table_names())
+        if "schema_version" not in tables or not set(metadata.tables) <= tables:
+            return False
+        version = conn.execute(text("SELECT MAX(version) FROM schema_version"))
+        return (version.scalar() or 0) >= MIGRATIONS[-1][0]
+
+
+def migrate(engine):
+    """Upgrade the database of engine in place, return the new version."""
+    with engine.begin() as conn:
+        version = get_schema_version(conn)
+    migrated = False
+    for step_version, description, step in MIGRATIONS:
+        if step_version <= version:
+            continue
+        with engine.begin() as conn:
+            step(conn)
+            conn.execute(
+                text("INSERT INTO schema_version (version) VALUES (:version)"),
+                {"version": step_version},
+            )
+        print(f"data.db migrated to version {step_version}: {description}")
+        version = step_version
+        migrated = True
+    if migrated:
+        # give the space of dropped columns and tables back to the file system
+        with engine.connect() as conn:
+            conn.execution_options(isolation_level="AUTOCOMMIT").execute(text("VACUUM"))
+    return version
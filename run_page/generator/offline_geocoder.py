@@ -0,0 +1,120 @@
+"""
+Reverse geocode start points offline from a local gazetteer file.
+
+The gazetteer is a tab separated text file, one place per line:
+
+    lat	lon	city	province	country
+
+lines starting with # are ignored. Places are indexed in an array backed
+k-d tree over unit sphere coordinates, so lookups need no network and
+work across the antimeridian.
+"""
+
+import math
+
+import numpy as np
+
+EARTH_RADIUS = 6371008.8
+
+
+def _to_xyz(lat, lon):
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    cos_lat = np.cos(lat)
+    return np.stack(
+        [cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)], axis=-1
+    )
+
+
+class OfflineGeocoder:
+    """
+    Attributes:
+        max_distance: places farther than this (meters) from a point are not
+            returned, so a run at sea does not resolve to the nearest city.
+
+    Methods:
+        reverse: nearest place for a point as "city, province, country"
+    """
+
+    def __init__(self, lats, lons, names, max_distance=50000):
+        self.names = list(names)
+        self.max_distance = max_distance
+        self.points = _to_xyz(np.asarray(lats, float), np.asarray(lons, float))
+        self.order = np.arange(len(self.names))
+        self._build()
+
+    @classmethod
+    def from_file(cls, file_name, max_distance=50000):
+        lats, lons, names = [], [], []
+        with open(file_name, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip() or line.startswith("#"):
+                    continue
+                lat, lon, *parts = line.rstrip("\n").split("\t")
+                lats.append(float(lat))
+                lons.append(float(lon))
+                names.append(", ".join(p for p in parts if p))
+        return cls(lats, lons, names, max_distance=max_distance)
+
+    def _build(self):
+        # implicit tree: the node of range [lo, hi) is its middle element,
+        # split on axis depth % 3, children are [lo, mid) and [mid + 1, hi)
+        stack = [(0, len(self.order), 0)]
+        while stack:
+            lo, hi, depth = stack.pop()
+            if hi - lo <= 1:
+                continue
+            mid = (lo + hi) // 2
+            axis = depth % 3
+            part = np.argpartition(self.points[self.order[lo:hi], axis], mid - lo)
+            self.order[lo:hi] = self.order[lo:hi][part]
+            stack.append((lo, mid, depth + 1))
+            stack.append((mid + 1, hi, depth + 1))
+        # plain lists are much faster than numpy for scalar access per node
+        self.tree = self.points[self.order].tolist()
+
+    def nearest(self, lat, lon):
+        """Return (index, distance in meters) of the nearest place."""
+        if not self.names:
+            return None, math.inf
+        lat, lon = math.radians(lat), math.radians(lon)
+        target = (
+            math.cos(lat) * math.cos(lon),
+            math.cos(lat) * math.sin(lon),
+            math.sin(lat),
+        )
+        tree = self.tree
+        best_index, best_dist = -1, math.inf
+        # (lo, hi, depth, squared distance to the splitting plane)
+        stack = [(0, len(tree), 0, 0.0)]
+        while stack:
+            lo, hi, depth, bound = stack.pop()
+            if lo >= hi or bound >= best_dist:
+                continue
+            mid = (lo + hi) // 2
+            node = tree[mid]
+            dist = (
+                (node[0] - target[0]) ** 2
+                + (node[1] - target[1]) ** 2
+                + (node[2] - target[2]) ** 2
+            )
+            if dist < best_dist:
+                best_index, best_dist = mid, dist
+            axis = depth % 3
+            diff = target[axis] - node[axis]
+            if diff < 0:
+                near, far = (lo, mid), (mid + 1, hi)
+            else:
+                near, far = (mid + 1, hi), (lo, mid)
+            # far side is pushed first so the near side is searched first
+            stack.append((*far, depth + 1, diff * diff))
+            stack.append((*near, depth + 1, 0.0))
+        chord = math.sqrt(best_dist)
+        distance = 2 * EARTH_RADIUS * math.asin(min(1.0, chord / 2))
+        return int(self.order[best_index]), distance
+
+    def reverse(self, lat, lon):
+        index, distance = self.nearest(lat, lon)
+        if index is None or distance > self.max_distance:
+            return None
+        return self.names[index]
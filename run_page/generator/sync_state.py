@@ -0,0 +1,100 @@
+"""
+Per provider sync state: the remote ids already synced and a high-water mark.
+
+    state = generator.sync_state("keep", activity_source="Keep")
+    new_runs = [run for run in runs if run_id(run) not in state]
+    ...
+    state.update(generator.sync_from_app(tracks))
+    state.advance(newest_start_timestamp)
+    state.save()
+
+Membership checks are set lookups, the ids are loaded with one query. A
+provider without ids yet starts from its activities in data.db, those with
+activity_source as Activity.source or a run_id starting with id_prefix. Until
+it has ids, every run_id in data.db counts as synced too, like
+get_old_tracks_ids, but only the provider's own ids are kept.
+"""
+
+import time
+
+from sqlalchemy import String, cast, or_, select
+
+from .db import Activity, SyncKnownId, SyncState
+
+
+class SourceSyncState:
+    def __init__(self, session, source, activity_source=None, id_prefix=None):
+        self.session = session
+        self.source = source
+        self.known = {
+            remote_id
+            for (remote_id,) in session.execute(
+                select(SyncKnownId.remote_id).where(SyncKnownId.source == source)
+            )
+        }
+        self.new_ids = set()
+        state = session.get(SyncState, source)
+        self.cursor = state.cursor if state else None
+        # run_ids of data.db checked until the provider has ids of its own
+        self.stored = set()
+        if not self.known:
+            owned = []
+            if activity_source:
+                owned.append(Activity.source == activity_source)
+            if id_prefix:
+                owned.append(cast(Activity.run_id, String).startswith(str(id_prefix)))
+            if owned:
+                self.update(
+                    run_id
+                    for (run_id,) in session.execute(
+                        select(Activity.run_id).where(or_(*owned))
+                    )
+                )
+            self.stored = {
+                str(run_id) for (run_id,) in session.execute(select(Activity.run_id))
+            }
+
+    def __contains__(self, remote_id):
+        remote_id = str(remote_id)
+        return remote_id in self.known or remote_id in self.stored
+
+    def __len__(self):
+        return len(self.known)
+
+    def add(self, remote_id):
+        remote_id = str(remote_id)
+        if remote_id not in self.known:
+            self.known.add(remote_id)
+            self.new_ids.add(remote_id)
+
+    def update(self, remote_ids):
+        for remote_id in remote_ids:
+            self.add(remote_id)
+
+    def advance(self, cursor):
+        """Move the high-water mark forward, never back. Cursors are compared
+        as numbers when both are numeric, otherwise as strings."""
+        if cursor is None:
+            return
+        cursor = str(cursor)
+        if self.cursor is None or _cursor_key(cursor) > _cursor_key(self.cursor):
+            self.cursor = cursor
+
+    def save(self):
+        if self.new_ids:
+            self.session.add_all(
+                SyncKnownId(source=self.source, remote_id=remote_id)
+                for remote_id in self.new_ids
+            )
+            self.new_ids = set()
+        self.session.merge(
+            SyncState(source=self.source, cursor=self.cursor, synced_at=time.time())
+        )
+        self.session.commit()
+
+
+def _cursor_key(cursor):
+    try:
+        return 0, float(cursor), ""
+    except ValueError:
+        return 1, 0.0, cursor
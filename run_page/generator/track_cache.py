@@ -0,0 +1,189 @@
+"""
+Summaries of parsed GPX/TCX/FIT files, keyed by the file content.
+
+    cache = TrackCache(TRACK_CACHE_FILE, signature)
+    if cache.state(file_name) == "unchanged":
+        unchanged.append(file_name)
+    for file_name, summary in cache.summaries(unchanged):
+        ...
+    cache.put(file_name, track.to_summary())
+    cache.commit()
+
+    # files a DirectoryManifest hashed already are not hashed again
+    cache.remember(manifest.hashes())
+
+The cache is its own SQLite file next to data.db, so data.db can be rebuilt
+from it without parsing a file again. A file is unchanged when its size and
+mtime match the entry, or, after a checkout touched every mtime, when its
+content hash does. Entries written with another signature (summary format,
+loader settings) are never returned.
+"""
+
+import hashlib
+import json
+import os
+import zlib
+from collections import namedtuple
+
+from sqlalchemy import Column, Integer, LargeBinary, String, select
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from .storage import create_storage_engine
+
+CacheBase = declarative_base()
+
+# paths per SELECT ... IN query
+QUERY_CHUNK_SIZE = 500
+
+# the columns of CachedTrack but the summary
+CacheEntry = namedtuple("CacheEntry", "path size mtime_ns content_hash signature")
+
+
+class CachedTrack(CacheBase):
+    __tablename__ = "track_cache"
+
+    # relative to the repository root, the same on every checkout
+    path = Column(String, primary_key=True)
+    size = Column(Integer)
+    mtime_ns = Column(Integer)
+    content_hash = Column(String, index=True)
+    signature = Column(String)
+    # zlib compressed json of Track.to_summary(), NULL for files that were
+    # only recorded as already imported
+    summary = Column(LargeBinary)
+
+
+def file_hash(file_name):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_name, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class TrackCache:
+    def __init__(self, cache_file, signature=""):
+        cache_file = os.path.abspath(cache_file)
+        self.root = os.path.dirname(os.path.dirname(cache_file))
+        self.signature = signature
+        engine = create_storage_engine(cache_file)
+        CacheBase.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        # everything but the summaries, those are read on a hit only
+        self.entries = {
+            row.path: row
+            for row in self.session.execute(
+                select(
+                    CachedTrack.path,
+                    CachedTrack.size,
+                    CachedTrack.mtime_ns,
+                    CachedTrack.content_hash,
+                    CachedTrack.signature,
+                )
+            )
+        }
+        self.by_hash = {row.content_hash: row.path for row in self.entries.values()}
+        # path: (size, mtime_ns, content hash) as seen by state()
+        self.seen = {}
+
+    def remember(self, hashes):
+        """
+        Take {file name: (size, mtime_ns, content hash)} hashed elsewhere, a
+        file whose size and mtime still match is not read to hash it again.
+        """
+        for file_name, seen in hashes.items():
+            self.seen[self._key(file_name)] = tuple(seen)
+
+    def _key(self, file_name):
+        return os.path.relpath(os.path.abspath(file_name), self.root)
+
+    def _look(self, file_name, with_hash):
+        key = self._key(file_name)
+        stat = os.stat(file_name)
+        seen = self.seen.get(key)
+        if seen is None or seen[:2] != (stat.st_size, stat.st_mtime_ns):
+            seen = (stat.st_size, stat.st_mtime_ns, None)
+        if with_hash and seen[2] is None:
+            seen = seen[:2] + (file_hash(file_name),)
+        self.seen[key] = seen
+        return key, seen
+
+    def state(self, file_name):
+        """ "new", "changed" or "unchanged" compared with the cache entry."""
+        key, (size, mtime_ns, _) = self._look(file_name, with_hash=False)
+        entry = self.entries.get(key)
+        if entry is None:
+            return "new"
+        if (entry.size, entry.mtime_ns) == (size, mtime_ns):
+            return "unchanged"
+        _, (_, _, content_hash) = self._look(file_name, with_hash=True)
+        if content_hash != entry.content_hash:
+            return "changed"
+        # only touched, remember the new mtime
+        self.session.query(CachedTrack).filter_by(path=key).update(
+            {"mtime_ns": mtime_ns}
+        )
+        return "unchanged"
+
+    def _entry_key(self, file_name):
+        """Key of the entry for file_name or for a copy of it, or None."""
+        key, (size, mtime_ns, _) = self._look(file_name, with_hash=False)
+        entry = self.entries.get(key)
+        if entry is None or (entry.size, entry.mtime_ns) != (size, mtime_ns):
+            # a new path, maybe a renamed or copied file
+            _, (_, _, content_hash) = self._look(file_name, with_hash=True)
+            key = self.by_hash.get(content_hash)
+            entry = self.entries.get(key)
+            if entry is None or entry.content_hash != content_hash:
+                return None
+        return key if entry.signature == self.signature else None
+
+    def summaries(self, file_names):
+        """
+        Yield (file name, cached summary or None) for every file, reading
+        QUERY_CHUNK_SIZE summaries at a time.
+        """
+        for i in range(0, len(file_names), QUERY_CHUNK_SIZE):
+            chunk = file_names[i : i + QUERY_CHUNK_SIZE]
+            keys = {file_name: self._entry_key(file_name) for file_name in chunk}
+            wanted = [key for key in keys.values() if key is not None]
+            data = dict(
+                self.session.execute(
+                    select(CachedTrack.path, CachedTrack.summary).where(
+                        CachedTrack.path.in_(wanted)
+                    )
+                ).all()
+            )
+            for file_name, key in keys.items():
+                if data.get(key) is None:
+                    yield file_name, None
+                    continue
+                summary = json.loads(zlib.decompress(data[key]))
+                summary["file_names"] = [os.path.basename(file_name)]
+                yield file_name, summary
+
+    def put(self, file_name, summary=None):
+        key, (size, mtime_ns, content_hash) = self._look(file_name, with_hash=True)
+        # summaries() of the same run finds what was put
+        self.entries[key] = CacheEntry(
+            key, size, mtime_ns, content_hash, self.signature
+        )
+        self.by_hash[content_hash] = key
+        self.session.merge(
+            CachedTrack(
+                path=key,
+                size=size,
+                mtime_ns=mtime_ns,
+                content_hash=content_hash,
+                signature=self.signature,
+                summary=(
+                    zlib.compress(json.dumps(summary).encode(), 9)
+                    if summary is not None
+                    else None
+                ),
+            )
+        )
+
+    def commit(self):
+        self.session.commit()
@@ -0,0 +1,145 @@
+"""
+Long running import of the files that land in GPX_OUT, TCX_OUT or FIT_OUT.
+
+    python run_page/gpx_sync.py --watch
+
+The folders are scanned every WATCH_INTERVAL seconds, or as soon as inotify
+reports a change when inotify_simple is installed. A burst of files is
+imported once nothing changed for WATCH_DEBOUNCE seconds, and at the latest
+WATCH_MAX_DELAY seconds after the first change, so files still being written
+are not parsed half way. sync_from_data_dir() then only parses the files the
+manifest does not have as imported, and export_json() only serializes the
+activities that changed. A failed import stays pending and is tried again
+after WATCH_INTERVAL seconds, doubling up to WATCH_MAX_RETRY_DELAY.
+
+The data.db writer lock is only held while importing, so the scheduled syncs
+run in between.
+"""
+
+import os
+import time
+import traceback
+
+from config import config
+
+from .manifest import DirectoryManifest
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+# seconds between two scans of the folders
+WATCH_INTERVAL = config("watch", "interval") or 2
+# seconds without a change before a burst of files is imported
+WATCH_DEBOUNCE = config("watch", "debounce") or 2
+# most seconds a change waits for the folders to settle
+WATCH_MAX_DELAY = config("watch", "max_delay") or 30
+# most seconds between two tries of a failed import
+WATCH_MAX_RETRY_DELAY = config("watch", "max_retry_delay") or 300
+
+
+def snapshot(folders):
+    """(file suffix, name): (size, mtime_ns) of the files in folders."""
+    state = {}
+    for file_suffix, folder in folders.items():
+        if not os.path.isdir(folder):
+            continue
+        for name, entry in DirectoryManifest(folder).scan(file_suffix).items():
+            stat = entry.stat()
+            state[(file_suffix, name)] = (stat.st_size, stat.st_mtime_ns)
+    return state
+
+
+class FolderWatcher:
+    """Waits WATCH_INTERVAL seconds, or less when inotify sees a change."""
+
+    def __init__(self, folders, interval=WATCH_INTERVAL):
+        self.interval = interval
+        self.inotify = None
+        if INotify is not None:
+            self.inotify = INotify()
+            mask = (
+                flags.CREATE
+                | flags.MODIFY
+                | flags.CLOSE_WRITE
+                | flags.MOVED_TO
+                | flags.MOVED_FROM
+                | flags.DELETE
+            )
+            for folder in folders.values():
+                if os.path.isdir(folder):
+                    self.inotify.add_watch(folder, mask)
+
+    def wait(self):
+        if self.inotify is not None:
+            self.inotify.read(timeout=int(self.interval * 1000))
+        else:
+            time.sleep(self.interval)
+
+
+def import_folders(generator, folders, json_file, for_mapping=False, **loader_args):
+    """Import the new and changed files of folders and export json_file."""
+    started = time.monotonic()
+    generator.writer_lock.acquire()
+    try:
+        for file_suffix, folder in folders.items():
+            if os.path.isdir(folder):
+                generator.sync_from_data_dir(folder, file_suffix, **loader_args)
+        generator.export_json(json_file, for_mapping=for_mapping)
+    finally:
+        generator.writer_lock.release()
+    print(f"imported in {time.monotonic() - started:.1f}s")
+
+
+def watch_folders(generator, folders, json_file, for_mapping=False, **loader_args):
+    """
+    Import what lands in folders, {file suffix: folder}, until interrupted.
+    Files that arrived while nothing was watching are imported first.
+    """
+    watcher = FolderWatcher(folders)
+    print(
+        f"watching {', '.join(folders.values())} "
+        f"({'inotify' if watcher.inotify else 'polling'}), Ctrl+C to stop"
+    )
+    previous = None
+    first_change = last_change = None
+    failures = 0
+    retry_at = 0
+    # the lock is taken again for every import
+    generator.writer_lock.release()
+    try:
+        while True:
+            current = snapshot(folders)
+            now = time.monotonic()
+            if current != previous:
+                previous = current
+                last_change = now
+                first_change = first_change or now
+            if (
+                first_change is not None
+                and now >= retry_at
+                and (
+                    now - last_change >= WATCH_DEBOUNCE
+                    or now - first_change >= WATCH_MAX_DELAY
+                )
+            ):
+                try:
+                    import_folders(
+                        generator, folders, json_file, for_mapping, **loader_args
+                    )
+                    first_change = None
+                    failures = 0
+                except Exception:
+                    # a bad file or a locked database, the batch stays pending
+                    traceback.print_exc()
+                    generator.session.rollback()
+                    failures += 1
+                    delay = min(
+                        WATCH_INTERVAL * 2 ** (failures - 1), WATCH_MAX_RETRY_DELAY
+                    )
+                    retry_at = time.monotonic() + delay
+                    print(f"import failed {failures} time(s), retrying in {delay}s")
+            watcher.wait()
+    except KeyboardInterrupt:
+        print("stopped watching")
@@ -4,6 +4,7 @@ import time
 
 import gpxpy as mod_gpxpy
 from config import GPX_FOLDER
+from generator.manifest import DirectoryManifest
 from strava_sync import run_strava_sync
 from stravalib.exc import ActivityUploadFailed, RateLimitTimeout
 from utils import get_strava_last_time, make_strava_client, upload_file_to_strava
@@ -14,20 +15,19 @@ def get_to_generate_files(last_time):
     reuturn to values one dict for upload
     and one sorted list for next time upload
     """
-    file_names = os.listdir(GPX_FOLDER)
+    file_names = DirectoryManifest(GPX_FOLDER).names("gpx")
     gpx_files = []
     for f in file_names:
-        if f.endswith(".gpx"):
-            file_path = os.path.join(GPX_FOLDER, f)
-            with open(file_path, "rb") as r:
-                try:
-                    gpx = mod_gpxpy.parse(r)
-                except Exception as e:
-                    print(f"Something is wring with {file_path} err: {str(e)}")
-                    continue
-                # if gpx file has no start time we ignore it.
-                if gpx.get_time_bounds()[0]:
-                    gpx_files.append((gpx, file_path))
+        file_path = os.path.join(GPX_FOLDER, f)
+        with open(file_path, "rb") as r:
+            try:
+                gpx = mod_gpxpy.parse(r)
+            except Exception as e:
+                print(f"Something is wring with {file_path} err: {str(e)}")
+                continue
+            # if gpx file has no start time we ignore it.
+            if gpx.get_time_bounds()[0]:
+                gpx_files.append((gpx, file_path))
     gpx_files_dict = {
         int(i[0].get_time_bounds()[0].timestamp()): i[1]
         for i in gpx_files
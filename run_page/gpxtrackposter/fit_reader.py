@@ -0,0 +1,238 @@
+"""
+Decode only the session and record messages of a FIT file.
+
+garmin_fit_sdk.Decoder.read() decodes every message of a file (device info,
+HRV, events, developer data...) into Python dicts, while a track only needs
+the first session and the lat/long of the records. This reader walks the
+message headers, skips the bytes of every other message, and decodes the
+records of each definition in bulk with one numpy structured array.
+
+CRCs are not checked, like the SDK decoder errors they would not stop the
+load anyway. Compressed timestamp headers are not supported by the SDK
+either and raise a ValueError.
+"""
+
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import struct
+from collections import namedtuple
+
+import numpy as np
+from garmin_fit_sdk.profile import Profile
+
+SESSION = Profile["mesg_num"]["SESSION"]
+RECORD = Profile["mesg_num"]["RECORD"]
+
+# base type number: (numpy type code, invalid value), from garmin_fit_sdk.fit
+BASE_TYPES = {
+    0x00: ("u1", 0xFF),
+    0x01: ("i1", 0x7F),
+    0x02: ("u1", 0xFF),
+    0x03: ("i2", 0x7FFF),
+    0x04: ("u2", 0xFFFF),
+    0x05: ("i4", 0x7FFFFFFF),
+    0x06: ("u4", 0xFFFFFFFF),
+    0x0A: ("u1", 0),
+    0x0B: ("u2", 0),
+    0x0C: ("u4", 0),
+    0x0D: ("u1", 0xFF),
+    0x0E: ("i8", 0x7FFFFFFFFFFFFFFF),
+    0x0F: ("u8", 0xFFFFFFFFFFFFFFFF),
+    0x10: ("u8", 0),
+}
+INVALID_SINT32 = 0x7FFFFFFF
+
+RECORD_FIELDS = {
+    field_id: Profile["messages"][RECORD]["fields"][field_id]
+    for field_id in (253, 0, 1, 2, 3, 78)
+}
+SESSION_FIELDS = {
+    field_id: Profile["messages"][SESSION]["fields"][field_id]
+    for field_id in (2, 5, 7, 8, 9, 14, 16, 59, 124)
+}
+
+FitRecords = namedtuple(
+    "FitRecords", "position_lat position_long timestamp altitude heart_rate"
+)
+FitRecords.__doc__ = """
+Record messages as arrays: semicircles as int32 (INVALID_SINT32 when
+missing), timestamp in FIT seconds (-1), altitude in meters (NaN) and
+heart_rate in bpm (0).
+"""
+
+MesgDef = namedtuple("MesgDef", "global_mesg_num endian fields size")
+
+
+def _scale(field_profile, raw_value):
+    # the same arithmetic as the SDK decoder, so the values are equal
+    scale = field_profile["scale"][0] if field_profile["scale"] else 1
+    offset = field_profile["offset"][0] if field_profile["offset"] else 0
+    value = raw_value / scale if scale != 1 else raw_value
+    return value - offset
+
+
+def _dtype(mesg_def, wanted):
+    names, formats, offsets = [], [], []
+    offset = 0
+    for field_id, size, base_type in mesg_def.fields:
+        if field_id in wanted and base_type in BASE_TYPES:
+            code, _ = BASE_TYPES[base_type]
+            if int(code[1]) == size:
+                names.append(str(field_id))
+                formats.append(mesg_def.endian + code)
+                offsets.append(offset)
+        offset += size
+    return np.dtype(
+        {
+            "names": names,
+            "formats": formats,
+            "offsets": offsets,
+            "itemsize": mesg_def.size,
+        }
+    )
+
+
+def _field_values(messages, mesg_def, field_id):
+    """Raw values of field_id and whether they are valid, None if absent."""
+    if str(field_id) not in (messages.dtype.names or ()):
+        return None
+    base_type = next(b for f, _, b in mesg_def.fields if f == field_id)
+    values = messages[str(field_id)]
+    return values, values != BASE_TYPES[base_type][1]
+
+
+def _decode_session(data, mesg_def):
+    message = np.frombuffer(data, dtype=_dtype(mesg_def, SESSION_FIELDS), count=1)
+    session = {}
+    for field_id, field_profile in SESSION_FIELDS.items():
+        field = _field_values(message, mesg_def, field_id)
+        if field is None or not field[1][0]:
+            continue
+        raw_value = field[0][0].item()
+        if field_profile["type"] == "sport":
+            session["sport"] = Profile["types"]["sport"].get(raw_value, raw_value)
+        else:
+            session[field_profile["name"]] = _scale(field_profile, raw_value)
+    # avg_speed is a component of enhanced_avg_speed, the SDK expands it
+    if "enhanced_avg_speed" not in session and "avg_speed" in session:
+        session["enhanced_avg_speed"] = session["avg_speed"]
+    return session
+
+
+def _decode_records(chunks, count):
+    position_lat = np.full(count, INVALID_SINT32, dtype=np.int32)
+    position_long = np.full(count, INVALID_SINT32, dtype=np.int32)
+    timestamp = np.full(count, -1, dtype=np.int64)
+    altitude = np.full(count, np.nan)
+    heart_rate = np.zeros(count, dtype=np.int64)
+    for mesg_def, (data, order) in chunks.items():
+        messages = np.frombuffer(bytes(data), dtype=_dtype(mesg_def, RECORD_FIELDS))
+        order = np.asarray(order)
+        for field_id, target in ((0, position_lat), (1, position_long)):
+            field = _field_values(messages, mesg_def, field_id)
+            if field is not None:
+                target[order[field[1]]] = field[0][field[1]]
+        field = _field_values(messages, mesg_def, 253)
+        if field is not None:
+            timestamp[order[field[1]]] = field[0][field[1]]
+        field = _field_values(messages, mesg_def, 3)
+        if field is not None:
+            heart_rate[order[field[1]]] = field[0][field[1]]
+        # enhanced_altitude wins over altitude, which the SDK expands into it
+        for field_id in (2, 78):
+            field = _field_values(messages, mesg_def, field_id)
+            if field is not None:
+                values = field[0][field[1]].astype(np.float64)
+                altitude[order[field[1]]] = _scale(RECORD_FIELDS[field_id], values)
+    return FitRecords(position_lat, position_long, timestamp, altitude, heart_rate)
+
+
+def read_fit(file_name):
+    """Return (first session message as a dict or None, FitRecords)."""
+    with open(file_name, "rb") as f:
+        data = f.read()
+    session = None
+    # record definition: (message bytes, index of each message in the file)
+    record_chunks = {}
+    record_count = 0
+    position = 0
+    while position < len(data):
+        header_size = data[position]
+        if data[position + 8 : position + 12] != b".FIT":
+            raise ValueError("The file is not a fit file.")
+        (data_size,) = struct.unpack_from("<I", data, position + 4)
+        end = position + header_size + data_size
+        position += header_size
+        definitions = {}
+        while position < end:
+            record_header = data[position]
+            position += 1
+            if record_header & 0x80:
+                raise ValueError(
+                    "Compressed timestamp messages are not currently supported"
+                )
+            local_mesg_num = record_header & 0x0F
+            if record_header & 0x40:
+                endian = ">" if data[position + 1] else "<"
+                (global_mesg_num,) = struct.unpack_from(
+                    endian + "H", data, position + 2
+                )
+                num_fields = data[position + 4]
+                position += 5
+                fields = [
+                    tuple(data[position + 3 * i : position + 3 * i + 3])
+                    for i in range(num_fields)
+                ]
+                fields = [(f, size, base & 0x1F) for f, size, base in fields]
+                position += 3 * num_fields
+                size = sum(size for _, size, _ in fields)
+                if record_header & 0x20:
+                    num_dev_fields = data[position]
+                    size += sum(
+                        data[position + 2 + 3 * i] for i in range(num_dev_fields)
+                    )
+                    position += 1 + 3 * num_dev_fields
+                definitions[local_mesg_num] = MesgDef(
+                    global_mesg_num, endian, tuple(fields), size
+                )
+                continue
+            mesg_def = definitions.get(local_mesg_num)
+            if mesg_def is None:
+                raise ValueError("Invalid local message number")
+            if mesg_def.global_mesg_num == RECORD:
+                chunk = record_chunks.setdefault(mesg_def, (bytearray(), []))
+                chunk[0].extend(data[position : position + mesg_def.size])
+                chunk[1].append(record_count)
+                record_count += 1
+            elif mesg_def.global_mesg_num == SESSION and session is None:
+                session = _decode_session(
+                    data[position : position + mesg_def.size], mesg_def
+                )
+            position += mesg_def.size
+        # file CRC
+        position = end + 2
+    return session, _decode_records(record_chunks, record_count)
+
+
+def records_from_messages(record_mesgs):
+    """FitRecords from the record_mesgs of garmin_fit_sdk.Decoder.read()."""
+    return FitRecords(
+        np.array(
+            [r.get("position_lat", INVALID_SINT32) for r in record_mesgs],
+            dtype=np.int32,
+        ),
+        np.array(
+            [r.get("position_long", INVALID_SINT32) for r in record_mesgs],
+            dtype=np.int32,
+        ),
+        np.array([r.get("timestamp", -1) for r in record_mesgs], dtype=np.int64),
+        np.array(
+            [
+                r.get("enhanced_altitude", r.get("altitude", np.nan))
+                for r in record_mesgs
+            ],
+            dtype=np.float64,
+        ),
+        np.array([r.get("heart_rate") or 0 for r in record_mesgs], dtype=np.int64),
+    )
@@ -0,0 +1,93 @@
+"""Bounding boxes, containment and distances on arrays of lat/lon degrees."""
+
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import math
+
+import numpy as np
+
+EARTH_RADIUS = 6378.137 * 1000
+
+
+def haversine(lats1, lons1, lats2, lons2, radius=EARTH_RADIUS):
+    """Great circle distance in meters between arrays of points in degrees."""
+    lats1, lons1, lats2, lons2 = map(np.radians, (lats1, lons1, lats2, lons2))
+    a = (
+        np.sin((lats2 - lats1) / 2) ** 2
+        + np.cos(lats1) * np.cos(lats2) * np.sin((lons2 - lons1) / 2) ** 2
+    )
+    return 2 * radius * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class BBox:
+    """
+    A lat/lon rectangle in degrees, what s2.LatLngRect was used for.
+
+    lng_lo > lng_hi means the box crosses the antimeridian, from lng_lo
+    east to 180 and on from -180 to lng_hi.
+
+    Methods:
+        from_points: the smallest box containing arrays of lats and lons
+        is_empty: True for the box of no points
+        contains: which of the points given as arrays are in the box
+        to_s2: the same box as s2.LatLngRect
+    """
+
+    __slots__ = ("lat_lo", "lat_hi", "lng_lo", "lng_hi")
+
+    def __init__(self, lat_lo=90.0, lat_hi=-90.0, lng_lo=180.0, lng_hi=-180.0):
+        # the defaults are the empty box, like s2.LatLngRect()
+        self.lat_lo = lat_lo
+        self.lat_hi = lat_hi
+        self.lng_lo = lng_lo
+        self.lng_hi = lng_hi
+
+    @classmethod
+    def from_points(cls, lats, lons):
+        if not len(lats):
+            return cls()
+        # the longitude range is the circle minus its largest gap between
+        # points, so tracks across the antimeridian get a narrow box too
+        lons = np.unique(lons)
+        gaps = np.diff(np.append(lons, lons[0] + 360))
+        gap = int(np.argmax(gaps))
+        return cls(
+            float(np.min(lats)),
+            float(np.max(lats)),
+            float(lons[(gap + 1) % len(lons)]),
+            float(lons[gap]),
+        )
+
+    def is_empty(self):
+        return self.lat_lo > self.lat_hi
+
+    def contains(self, lats, lons):
+        lats = np.asarray(lats)
+        lons = np.asarray(lons)
+        inside = (lats >= self.lat_lo) & (lats <= self.lat_hi)
+        if self.lng_lo <= self.lng_hi:
+            return inside & (lons >= self.lng_lo) & (lons <= self.lng_hi)
+        return inside & ((lons >= self.lng_lo) | (lons <= self.lng_hi))
+
+    def to_s2(self):
+        import s2sphere as s2
+
+        if self.is_empty():
+            return s2.LatLngRect()
+        return s2.LatLngRect(
+            s2.LineInterval(math.radians(self.lat_lo), math.radians(self.lat_hi)),
+            s2.SphereInterval(math.radians(self.lng_lo), math.radians(self.lng_hi)),
+        )
+
+    def __repr__(self):
+        return (
+            f"BBox(lat {self.lat_lo}..{self.lat_hi}, lng {self.lng_lo}..{self.lng_hi})"
+        )
+
+
+def mercator(lats, lons):
+    """Arrays of x in [0, 2] and y, the vectorized utils.lng2x and utils.lat2y."""
+    x = np.asarray(lons) / 180 + 1
+    y = 0.5 - np.log(np.tan(math.pi / 4 * (1 + np.asarray(lats) / 90))) / math.pi
+    return x, y
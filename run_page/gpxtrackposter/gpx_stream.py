@@ -0,0 +1,154 @@
+"""Read GPX files in a single streaming pass with lxml.etree.iterparse."""
+
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import math
+from array import array
+
+import numpy as np
+from gpxpy.gpxfield import parse_time
+from lxml import etree
+
+from .track_points import EPOCH, NO_TIME, ONE_MICROSECOND, TrackPoints
+
+
+class StreamedGPX:
+    """
+    The points of a GPX file in flat arrays, one entry per <trkpt>.
+
+    Attributes:
+        segments: (first point, end point) of every <trkseg>
+
+    Methods:
+        points: all points as TrackPoints
+    """
+
+    def __init__(self):
+        self.creator = None
+        self.name = None
+        self.track_type = None
+        self.track_source = None
+        self.track_name = None
+        self.track_number = None
+        self.lats = array("d")
+        self.lons = array("d")
+        self.eles = array("d")
+        self.times = array("q")
+        self.heart_rates = array("i")
+        self.segments = []
+        self.start_time = None
+        self.end_time = None
+
+    def get_time_bounds(self):
+        return self.start_time, self.end_time
+
+    def points(self):
+        return TrackPoints(
+            np.frombuffer(self.lats, dtype=np.float64),
+            np.frombuffer(self.lons, dtype=np.float64),
+            np.frombuffer(self.times, dtype=np.int64),
+            np.frombuffer(self.eles, dtype=np.float64),
+            np.frombuffer(self.heart_rates, dtype=np.int32),
+            [first for first, _ in self.segments],
+        )
+
+
+def _localname(element):
+    return element.tag.rpartition("}")[2]
+
+
+def _child_texts(element):
+    return {
+        _localname(child): child.text for child in element if isinstance(child.tag, str)
+    }
+
+
+def _point_heart_rate(extensions):
+    # like the gpxpy loader, only the children of the first extension
+    # element are looked at (gpxtpx:TrackPointExtension/gpxtpx:hr)
+    for extension in extensions.iterchildren(tag=etree.Element):
+        for child in extension.iterchildren(tag=etree.Element):
+            if _localname(child) == "hr":
+                try:
+                    return int(child.text)
+                except (TypeError, ValueError):
+                    return 0
+        return 0
+    return 0
+
+
+def _clear_point(element):
+    element.clear()
+    # drop the already handled points too, the segment keeps them otherwise
+    parent = element.getparent()
+    while element.getprevious() is not None:
+        del parent[0]
+
+
+def read_gpx(file_name):
+    """Parse file_name into a StreamedGPX in one pass over the XML events."""
+    gpx = StreamedGPX()
+    lats, lons, eles = gpx.lats, gpx.lons, gpx.eles
+    times, heart_rates = gpx.times, gpx.heart_rates
+    segment_start = 0
+    track_index = 0
+    context = etree.iterparse(
+        file_name,
+        events=("end",),
+        tag=("{*}trkpt", "{*}trkseg", "{*}trk", "{*}metadata"),
+        huge_tree=True,
+        remove_blank_text=True,
+    )
+    for _, element in context:
+        tag = _localname(element)
+        if tag == "trkpt":
+            lat = float(element.get("lat"))
+            lon = float(element.get("lon"))
+            ele = math.nan
+            time = NO_TIME
+            heart_rate = 0
+            for child in element:
+                if not isinstance(child.tag, str):
+                    continue
+                name = _localname(child)
+                if name == "ele" and child.text is not None:
+                    ele = float(child.text.strip())
+                elif name == "time" and child.text:
+                    point_time = parse_time(child.text)
+                    if point_time is not None:
+                        time = (point_time - EPOCH) // ONE_MICROSECOND
+                        if gpx.start_time is None:
+                            gpx.start_time = point_time
+                        gpx.end_time = point_time
+                elif name == "extensions":
+                    heart_rate = _point_heart_rate(child)
+            lats.append(lat)
+            lons.append(lon)
+            eles.append(ele)
+            times.append(time)
+            heart_rates.append(heart_rate)
+            _clear_point(element)
+        elif tag == "trkseg":
+            gpx.segments.append((segment_start, len(lats)))
+            segment_start = len(lats)
+            element.clear()
+        elif tag == "trk":
+            if track_index == 0:
+                fields = _child_texts(element)
+                gpx.track_type = fields.get("type")
+                gpx.track_source = fields.get("src")
+                gpx.track_name = fields.get("name")
+                if fields.get("number") is not None:
+                    gpx.track_number = int(fields["number"].strip())
+            track_index += 1
+            element.clear()
+        elif tag == "metadata":
+            # GPX 1.1 keeps the file name in <metadata>
+            gpx.name = _child_texts(element).get("name")
+    root = context.root
+    gpx.creator = root.get("creator")
+    if gpx.name is None:
+        # GPX 1.0 has it right below <gpx>
+        gpx.name = _child_texts(root).get("name")
+    return gpx
@@ -0,0 +1,220 @@
+"""Read TCX files in a single streaming pass with lxml.etree.iterparse."""
+
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import math
+import re
+from array import array
+
+import numpy as np
+from lxml import etree
+
+from .track_points import TrackPoints, datetime_to_micros
+
+TCX_NS = "{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}"
+ACTIVITIES = TCX_NS + "Activities"
+ACTIVITY = TCX_NS + "Activity"
+LAP = TCX_NS + "Lap"
+TRACK = TCX_NS + "Track"
+TRACKPOINT = TCX_NS + "Trackpoint"
+TIME = TCX_NS + "Time"
+POSITION = TCX_NS + "Position"
+LATITUDE = TCX_NS + "LatitudeDegrees"
+LONGITUDE = TCX_NS + "LongitudeDegrees"
+ALTITUDE = TCX_NS + "AltitudeMeters"
+HEART_RATE = TCX_NS + "HeartRateBpm"
+DISTANCE = TCX_NS + "DistanceMeters"
+
+# the formats tcxreader tries, in its order: "Z" gives naive datetimes
+TIME_FORMATS = (
+    "%Y-%m-%dT%H:%M:%S.%fZ",
+    "%Y-%m-%dT%H:%M:%S.%f%z",
+    "%Y-%m-%dT%H:%M:%SZ",
+    "%Y-%m-%dT%H:%M:%S%z",
+)
+TIME_RE = re.compile(
+    r"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?"
+    r"(?:(Z)|([+-])(\d\d):?(\d\d))"
+)
+
+
+def parse_time(text):
+    """Parse a <Time> like tcxreader does, without strptime for common ones."""
+    match = TIME_RE.fullmatch(text)
+    if match is None:
+        for time_format in TIME_FORMATS:
+            try:
+                return datetime.datetime.strptime(text, time_format)
+            except ValueError:
+                continue
+        raise ValueError(f"Cannot parse time {text!r}")
+    year, month, day, hour, minute, second, fraction = match.group(1, 2, 3, 4, 5, 6, 7)
+    zulu, sign, offset_hours, offset_minutes = match.group(8, 9, 10, 11)
+    tzinfo = None
+    if zulu is None:
+        offset = datetime.timedelta(
+            hours=int(offset_hours), minutes=int(offset_minutes)
+        )
+        tzinfo = datetime.timezone(-offset if sign == "-" else offset)
+    return datetime.datetime(
+        int(year),
+        int(month),
+        int(day),
+        int(hour),
+        int(minute),
+        int(second),
+        int(fraction.ljust(6, "0")) if fraction else 0,
+        tzinfo,
+    )
+
+
+def _float(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def _int(text):
+    try:
+        return int(float(text))
+    except (TypeError, ValueError):
+        return None
+
+
+class StreamedTCX:
+    """
+    The trackpoints of a TCX file in flat arrays, only the ones with a
+    longitude like tcxreader keeps them.
+
+    Attributes:
+        distance: sum of the DistanceMeters of all laps
+        hr_avg: average heart rate of the points that have one, or None
+        start_time, end_time: times of the first and last point
+
+    Methods:
+        points: the points with a position as TrackPoints
+    """
+
+    def __init__(self):
+        self.distance = 0.0
+        self.hr_avg = None
+        self.start_time = None
+        self.end_time = None
+        self.located = array("b")
+        self.lats = array("d")
+        self.lons = array("d")
+        self.times = array("q")
+        self.elevations = array("d")
+        self.heart_rates = array("q")
+
+    def __len__(self):
+        return len(self.lons)
+
+    def append(self, lat, lon, time, elevation, heart_rate):
+        self.located.append(lat is not None)
+        self.lats.append(math.nan if lat is None else lat)
+        self.lons.append(lon)
+        self.times.append(datetime_to_micros(time))
+        self.elevations.append(math.nan if elevation is None else elevation)
+        self.heart_rates.append(heart_rate or 0)
+        if len(self.lons) == 1:
+            self.start_time = time
+        self.end_time = time
+
+    def points(self):
+        located = np.frombuffer(self.located, dtype=np.int8).astype(bool)
+        return TrackPoints(
+            np.frombuffer(self.lats, dtype=np.float64)[located],
+            np.frombuffer(self.lons, dtype=np.float64)[located],
+            np.frombuffer(self.times, dtype=np.int64)[located],
+            np.frombuffer(self.elevations, dtype=np.float64)[located],
+            np.frombuffer(self.heart_rates, dtype=np.int64)[located],
+        )
+
+
+def _is_activity_lap(lap):
+    # Activities/Activity/Lap right below the root, the only laps tcxreader reads
+    if lap is None or lap.tag != LAP:
+        return False
+    activity = lap.getparent()
+    if activity is None or activity.tag != ACTIVITY:
+        return False
+    activities = activity.getparent()
+    if activities is None or activities.tag != ACTIVITIES:
+        return False
+    root = activities.getparent()
+    return root is not None and root.getparent() is None
+
+
+def _clear_trackpoint(element):
+    element.clear()
+    # drop the already handled trackpoints too, the track keeps them otherwise
+    parent = element.getparent()
+    while element.getprevious() is not None:
+        del parent[0]
+
+
+def read_tcx(file_name):
+    """Parse file_name into a StreamedTCX in one pass over the XML events."""
+    tcx = StreamedTCX()
+    hr_sum = hr_count = 0
+    checked_track, in_lap = None, False
+    context = etree.iterparse(
+        file_name, events=("end",), tag=(TRACKPOINT, LAP), huge_tree=True
+    )
+    for _, element in context:
+        if element.tag == LAP:
+            if _is_activity_lap(element):
+                for child in element:
+                    if child.tag == DISTANCE:
+                        tcx.distance += float(child.text)
+            element.clear()
+            continue
+        track = element.getparent()
+        if track is not checked_track:
+            checked_track = track
+            in_lap = track.tag == TRACK and _is_activity_lap(track.getparent())
+        if not in_lap:
+            element.clear()
+            continue
+        lat = lon = time = elevation = heart_rate = None
+        for child in element:
+            tag = child.tag
+            if tag == TIME:
+                time = parse_time(child.text)
+            elif tag == POSITION:
+                for position in child:
+                    if position.tag == LATITUDE:
+                        lat = _float(position.text)
+                    elif position.tag == LONGITUDE:
+                        lon = _float(position.text)
+            elif tag == ALTITUDE:
+                elevation = _float(child.text)
+            elif tag == HEART_RATE:
+                for value in child:
+                    heart_rate = _int(value.text)
+        _clear_trackpoint(element)
+        if lon is None:
+            continue
+        tcx.append(lat, lon, time, elevation, heart_rate)
+        if heart_rate is not None:
+            hr_sum += heart_rate
+            hr_count += 1
+    if hr_count:
+        tcx.hr_avg = hr_sum / hr_count
+    return tcx
+
+
+def from_tcx_exercise(exercise):
+    """StreamedTCX from the TCXExercise of tcxreader.TCXReader.read()."""
+    tcx = StreamedTCX()
+    tcx.distance = exercise.distance
+    tcx.hr_avg = exercise.hr_avg
+    for point in exercise.trackpoints:
+        tcx.append(
+            point.latitude, point.longitude, point.time, point.elevation, point.hr_value
+        )
+    return tcx
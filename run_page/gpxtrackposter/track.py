@@ -11,21 +11,28 @@ from collections import namedtuple
 
 import gpxpy as mod_gpxpy
 import lxml
-import polyline
-import s2sphere as s2
+import numpy as np
 from garmin_fit_sdk import Decoder, Stream
+from config import config, run_map
 from garmin_fit_sdk.util import FIT_EPOCH_S
+import polyline_codec
 from polyline_processor import filter_out
+from polyline_simplifier import SIMPLIFY_MAX_POINTS, SIMPLIFY_TOLERANCE
 from rich import print
 from tcxreader.tcxreader import TCXReader
 
 from .exceptions import TrackLoadError
+from .fit_reader import INVALID_SINT32, FitRecords, read_fit, records_from_messages
+from .gpx_stream import read_gpx
+from .tcx_stream import from_tcx_exercise, read_tcx
+from .track_points import NO_TIME, ONE_MICROSECOND, TrackPoints, datetime_to_micros
 from .utils import parse_datetime_to_local
 
 start_point = namedtuple("start_point", "lat lon")
-run_map = namedtuple("polyline", "summary_polyline")
 
 IGNORE_BEFORE_SAVING = os.getenv("IGNORE_BEFORE_SAVING", False)
+# km/h, a step between two points slower than this counts as stopped time
+STOPPED_SPEED_THRESHOLD = config("track", "stopped_speed_threshold") or 1
 
 # Garmin stores all latitude and longitude values as 32-bit integer values.
 # This unit is called semicircle.
@@ -35,10 +42,37 @@ IGNORE_BEFORE_SAVING = os.getenv("IGNORE_BEFORE_SAVING", False)
 SEMICIRCLE = 11930465
 
 
+def _isoformat(time):
+    return time.isoformat() if time else None
+
+
+def _fromisoformat(text):
+    return datetime.datetime.fromisoformat(text) if text else None
+
+
 class Track:
+    __slots__ = (
+        "file_names",
+        "_points",
+        "polyline_str",
+        "start_time",
+        "end_time",
+        "start_time_local",
+        "end_time_local",
+        "length",
+        "special",
+        "average_heartrate",
+        "moving_dict",
+        "run_id",
+        "start_latlng",
+        "type",
+        "source",
+        "name",
+    )
+
     def __init__(self):
         self.file_names = []
-        self.polylines = []
+        self.points = TrackPoints()
         self.polyline_str = ""
         self.start_time = None
         self.end_time = None
@@ -54,9 +88,12 @@ class Track:
         self.source = ""
         self.name = ""
 
-    def load_gpx(self, file_name):
+    def load_gpx(self, file_name, streaming=False):
         """
         TODO refactor with load_tcx to one function
+
+        streaming reads the file with one iterparse pass into flat arrays
+        instead of building the whole gpxpy object tree.
         """
         try:
             self.file_names = [os.path.basename(file_name)]
@@ -64,8 +101,11 @@ class Track:
             # (for example, treadmill runs pulled via garmin-connect-export)
             if os.path.getsize(file_name) == 0:
                 raise TrackLoadError("Empty GPX file")
-            with open(file_name, "rb") as file:
-                self._load_gpx_data(mod_gpxpy.parse(file))
+            if streaming:
+                self._load_gpx_stream_data(read_gpx(file_name))
+            else:
+                with open(file_name, "rb") as file:
+                    self._load_gpx_data(mod_gpxpy.parse(file))
         except Exception as e:
             print(
                 f"Something went wrong when loading GPX. for file {self.file_names[0]}, we just ignore this file and continue"
@@ -73,41 +113,52 @@ class Track:
             print(str(e))
             pass
 
-    def load_tcx(self, file_name):
+    def load_tcx(self, file_name, streaming=False):
         try:
             self.file_names = [os.path.basename(file_name)]
             # Handle empty tcx files
             # (for example, treadmill runs pulled via garmin-connect-export)
-            tcx = TCXReader()
             if os.path.getsize(file_name) == 0:
                 raise TrackLoadError("Empty TCX file")
-            self._load_tcx_data(tcx.read(file_name), file_name=file_name)
+            if streaming:
+                tcx = read_tcx(file_name)
+            else:
+                tcx = from_tcx_exercise(TCXReader().read(file_name))
+            self._load_tcx_data(tcx, file_name=file_name)
         except Exception as e:
             print(
                 f"Something went wrong when loading TCX. for file {self.file_names[0]}, we just ignore this file and continue"
             )
             print(str(e))
 
-    def load_fit(self, file_name):
+    def load_fit(self, file_name, fast=False):
         try:
             self.file_names = [os.path.basename(file_name)]
             # Handle empty fit files
             # (for example, treadmill runs pulled via garmin-connect-export)
             if os.path.getsize(file_name) == 0:
                 raise TrackLoadError("Empty FIT file")
-            stream = Stream.from_file(file_name)
-            decoder = Decoder(stream)
-            messages, errors = decoder.read(convert_datetimes_to_dates=False)
-            if errors:
-                print(f"FIT file read fail: {errors}")
-            self._load_fit_data(messages)
+            if fast:
+                # only the session and record messages, see fit_reader.py
+                session, records = read_fit(file_name)
+                if session is None:
+                    raise TrackLoadError("No session in FIT file")
+            else:
+                stream = Stream.from_file(file_name)
+                decoder = Decoder(stream)
+                messages, errors = decoder.read(convert_datetimes_to_dates=False)
+                if errors:
+                    print(f"FIT file read fail: {errors}")
+                session = messages["session_mesgs"][0]
+                records = records_from_messages(messages.get("record_mesgs", []))
+            self._load_fit_data(session, records)
         except Exception as e:
             print(
                 f"Something went wrong when loading FIT. for file {self.file_names[0]}, we just ignore this file and continue"
             )
             print(str(e))
 
-    def load_from_db(self, activity):
+    def load_from_db(self, activity, with_geometry=True):
         # use strava as file name
         self.file_names = [str(activity.run_id)]
         start_time = datetime.datetime.strptime(
@@ -116,21 +167,97 @@ class Track:
         self.start_time_local = start_time
         self.end_time = start_time + activity.elapsed_time
         self.length = float(activity.distance)
+        self.run_id = activity.run_id
+        if not with_geometry:
+            # skip loading the geometry row at all
+            return
         if IGNORE_BEFORE_SAVING:
             summary_polyline = filter_out(activity.summary_polyline)
         else:
             summary_polyline = activity.summary_polyline
-        polyline_data = polyline.decode(summary_polyline) if summary_polyline else []
-        self.polylines = [[s2.LatLng.from_degrees(p[0], p[1]) for p in polyline_data]]
-        self.run_id = activity.run_id
+        polyline_data = (
+            polyline_codec.decode_array(summary_polyline) if summary_polyline else []
+        )
+        self.points = TrackPoints.from_latlngs(polyline_data)
+
+    def to_summary(self):
+        """The loaded values as plain json types, see load_from_summary."""
+        return {
+            "file_names": self.file_names,
+            "run_id": self.run_id,
+            "name": self.name,
+            "type": self.type,
+            "source": self.source,
+            "start_time": _isoformat(self.start_time),
+            "end_time": _isoformat(self.end_time),
+            "start_time_local": _isoformat(self.start_time_local),
+            "end_time_local": _isoformat(self.end_time_local),
+            "length": self.length,
+            "average_heartrate": self.average_heartrate,
+            "moving_dict": {
+                key: (
+                    value // ONE_MICROSECOND
+                    if isinstance(value, datetime.timedelta)
+                    else value
+                )
+                for key, value in self.moving_dict.items()
+            },
+            "start_latlng": list(self.start_latlng),
+            "polyline": self.polyline_str,
+        }
+
+    def load_from_summary(self, summary):
+        """Restore a track from to_summary(), the points from its polyline."""
+        self.file_names = list(summary["file_names"])
+        self.run_id = summary["run_id"]
+        self.name = summary["name"]
+        self.type = summary["type"]
+        self.source = summary["source"]
+        self.start_time = _fromisoformat(summary["start_time"])
+        self.end_time = _fromisoformat(summary["end_time"])
+        self.start_time_local = _fromisoformat(summary["start_time_local"])
+        self.end_time_local = _fromisoformat(summary["end_time_local"])
+        self.length = summary["length"]
+        self.average_heartrate = summary["average_heartrate"]
+        self.moving_dict = {
+            key: (
+                datetime.timedelta(microseconds=value)
+                if key in ("moving_time", "elapsed_time")
+                else value
+            )
+            for key, value in summary["moving_dict"].items()
+        }
+        if summary["start_latlng"]:
+            self.start_latlng = start_point(*summary["start_latlng"])
+        self.polyline_str = summary["polyline"]
+        if self.polyline_str:
+            # decoded on first use, only merged and drawn tracks need them
+            self._points = None
+
+    @property
+    def points(self):
+        if self._points is None:
+            self._points = TrackPoints.from_latlngs(
+                polyline_codec.decode_array(self.polyline_str)
+            )
+        return self._points
+
+    @points.setter
+    def points(self, points):
+        self._points = points
+
+    @property
+    def polylines(self):
+        """The points as one list of s2.LatLng per segment, built on demand."""
+        return self.points.s2_lines()
+
+    @property
+    def polyline_container(self):
+        return self.points.latlngs()
 
     def bbox(self):
         """Compute the smallest rectangle that contains the entire track (border box)."""
-        bbox = s2.LatLngRect()
-        for line in self.polylines:
-            for latlng in line:
-                bbox = bbox.union(s2.LatLngRect.from_point(latlng.normalized()))
-        return bbox
+        return self.points.bbox()
 
     @staticmethod
     def __make_run_id(time_stamp):
@@ -138,42 +265,39 @@ class Track:
 
     def _load_tcx_data(self, tcx, file_name):
         self.length = float(tcx.distance)
-        time_values = [i.time for i in tcx.trackpoints]
-        if not time_values:
+        if not len(tcx):
             raise TrackLoadError("Track is empty.")
 
-        self.start_time, self.end_time = time_values[0], time_values[-1]
+        self.start_time, self.end_time = tcx.start_time, tcx.end_time
         moving_time = int(self.end_time.timestamp() - self.start_time.timestamp())
         self.run_id = self.__make_run_id(self.start_time)
         self.average_heartrate = tcx.hr_avg
-        polyline_container = []
-        position_values = [(i.latitude, i.longitude) for i in tcx.trackpoints]
-        if not position_values and int(self.length) == 0:
+        points = tcx.points()
+        if not len(points) and int(self.length) == 0:
             raise Exception(
                 f"This {file_name} TCX file do not contain distance and position values we ignore it"
             )
-        if position_values:
-            line = [s2.LatLng.from_degrees(p[0], p[1]) for p in position_values]
-            self.polylines.append(line)
-            polyline_container.extend([[p[0], p[1]] for p in position_values])
-            self.polyline_container = polyline_container
-            self.start_time_local, self.end_time_local = parse_datetime_to_local(
-                self.start_time, self.end_time, polyline_container[0]
-            )
-            # get start point
-            try:
-                self.start_latlng = start_point(*polyline_container[0])
-            except:
-                pass
-            self.polyline_str = polyline.encode(polyline_container)
         self.moving_dict = {
             "distance": self.length,
             "moving_time": datetime.timedelta(seconds=moving_time),
             "elapsed_time": datetime.timedelta(
                 seconds=moving_time
-            ),  # FIXME for now make it same as moving time
+            ),  # treadmill files without positions only have the totals
             "average_speed": self.length / moving_time if moving_time else 0,
         }
+        if len(points):
+            self._set_moving_data(points)
+            self.points = points.simplify()
+            first_point = self.points.first()
+            self.start_time_local, self.end_time_local = parse_datetime_to_local(
+                self.start_time, self.end_time, first_point
+            )
+            # get start point
+            try:
+                self.start_latlng = start_point(*first_point)
+            except:
+                pass
+            self.polyline_str = self.points.encode_polyline()
 
     def _load_gpx_data(self, gpx):
         self.start_time, self.end_time = gpx.get_time_bounds()
@@ -183,11 +307,10 @@ class Track:
             raise TrackLoadError("Track has no start time.")
         if self.end_time is None:
             raise TrackLoadError("Track has no end time.")
-        self.length = gpx.length_2d()
+        points = self._gpxpy_points(gpx)
+        self._set_moving_data(points)
         if self.length == 0:
             raise TrackLoadError("Track is empty.")
-        gpx.simplify()
-        polyline_container = []
         heart_rate_list = []
         # determinate type
         if gpx.tracks[0].type:
@@ -229,30 +352,89 @@ class Track:
                     heart_rate_list = list(filter(None, heart_rate_list))
                 except:
                     pass
-                line = [
-                    s2.LatLng.from_degrees(p.latitude, p.longitude) for p in s.points
-                ]
-                self.polylines.append(line)
-                polyline_container.extend([[p.latitude, p.longitude] for p in s.points])
-                self.polyline_container = polyline_container
+        self.points = points.simplify()
+        first_point = self.points.first()
         # get start point
         try:
-            self.start_latlng = start_point(*polyline_container[0])
+            self.start_latlng = start_point(*first_point)
         except:
             pass
         self.start_time_local, self.end_time_local = parse_datetime_to_local(
-            self.start_time, self.end_time, polyline_container[0]
+            self.start_time, self.end_time, first_point
         )
-        self.polyline_str = polyline.encode(polyline_container)
+        self.polyline_str = self.points.encode_polyline()
         self.average_heartrate = (
             sum(heart_rate_list) / len(heart_rate_list) if heart_rate_list else None
         )
-        self.moving_dict = self._get_moving_data(gpx)
 
-    def _load_fit_data(self, fit: dict):
-        _polylines = []
-        self.polyline_container = []
-        message = fit["session_mesgs"][0]
+    @staticmethod
+    def _gpxpy_points(gpx):
+        lats, lons, times, elevations, segment_starts = [], [], [], [], []
+        for t in gpx.tracks:
+            for s in t.segments:
+                segment_starts.append(len(lats))
+                for p in s.points:
+                    lats.append(p.latitude)
+                    lons.append(p.longitude)
+                    times.append(datetime_to_micros(p.time))
+                    elevations.append(np.nan if p.elevation is None else p.elevation)
+        return TrackPoints(
+            lats,
+            lons,
+            times=times,
+            elevations=elevations,
+            segment_starts=segment_starts,
+        )
+
+    def _load_gpx_stream_data(self, gpx):
+        self.start_time, self.end_time = gpx.get_time_bounds()
+        if self.start_time is None:
+            raise TrackLoadError("Track has no start time.")
+        if self.end_time is None:
+            raise TrackLoadError("Track has no end time.")
+        # use timestamp as id
+        self.run_id = self.__make_run_id(self.start_time)
+        # distances and times come from every point, the geometry is simplified
+        points = gpx.points()
+        self._set_moving_data(points)
+        if self.length == 0:
+            raise TrackLoadError("Track is empty.")
+        # determinate type
+        if gpx.track_type:
+            self.type = gpx.track_type
+        # determinate source
+        if gpx.creator:
+            self.source = gpx.creator
+        elif gpx.track_source:
+            self.source = gpx.track_source
+        if self.source == "xingzhe":
+            self.start_time_local = self.start_time
+            self.run_id = gpx.track_number
+        # determinate name
+        if gpx.name:
+            self.name = gpx.name
+        elif gpx.track_name:
+            self.name = gpx.track_name
+        else:
+            self.name = self.type + " from " + self.source
+
+        self.points = points.simplify()
+        first_point = self.points.first()
+        heart_rate_list = points.heart_rates[points.heart_rates > 0].tolist()
+        # get start point
+        try:
+            self.start_latlng = start_point(*first_point)
+        except:
+            pass
+        self.start_time_local, self.end_time_local = parse_datetime_to_local(
+            self.start_time, self.end_time, first_point
+        )
+        self.polyline_str = self.points.encode_polyline()
+        self.average_heartrate = (
+            sum(heart_rate_list) / len(heart_rate_list) if heart_rate_list else None
+        )
+
+    def _load_fit_data(self, message: dict, records: FitRecords):
         self.start_time = datetime.datetime.utcfromtimestamp(
             (message["start_time"] + FIT_EPOCH_S)
         )
@@ -283,19 +465,26 @@ class Track:
             if message["enhanced_avg_speed"]
             else message["avg_speed"]
         )
-        for record in fit["record_mesgs"]:
-            if "position_lat" in record and "position_long" in record:
-                lat = record["position_lat"] / SEMICIRCLE
-                lng = record["position_long"] / SEMICIRCLE
-                _polylines.append(s2.LatLng.from_degrees(lat, lng))
-                self.polyline_container.append([lat, lng])
-        if self.polyline_container:
+        located = (records.position_lat != INVALID_SINT32) & (
+            records.position_long != INVALID_SINT32
+        )
+        timestamps = records.timestamp[located]
+        points = TrackPoints(
+            records.position_lat[located] / SEMICIRCLE,
+            records.position_long[located] / SEMICIRCLE,
+            np.where(timestamps >= 0, (timestamps + FIT_EPOCH_S) * 10**6, NO_TIME),
+            records.altitude[located],
+            records.heart_rate[located],
+        )
+        if len(points):
+            self._set_moving_data(points)
+            self.points = points.simplify()
+            first_point = self.points.first()
             self.start_time_local, self.end_time_local = parse_datetime_to_local(
-                self.start_time, self.end_time, self.polyline_container[0]
+                self.start_time, self.end_time, first_point
             )
-            self.start_latlng = start_point(*self.polyline_container[0])
-            self.polylines.append(_polylines)
-            self.polyline_str = polyline.encode(self.polyline_container)
+            self.start_latlng = start_point(*first_point)
+            self.polyline_str = self.points.encode_polyline()
         else:
             self.start_time_local, self.end_time_local = parse_datetime_to_local(
                 self.start_time, self.end_time, None
@@ -303,41 +492,58 @@ class Track:
 
     def append(self, other):
         """Append other track to self."""
-        self.end_time = other.end_time
-        self.length += other.length
+        self.merge([other])
+
+    def merge(self, others):
+        """
+        Append all of others to self at once: the points are concatenated,
+        simplified and encoded once and the moving data summed once, instead
+        of once per appended track.
+        """
+        others = list(others)
+        if not others:
+            return
+        self.end_time = others[-1].end_time
+        self.length += sum(other.length for other in others)
         # TODO maybe a better way
         try:
-            self.moving_dict["distance"] += other.moving_dict["distance"]
-            self.moving_dict["moving_time"] += other.moving_dict["moving_time"]
-            self.moving_dict["elapsed_time"] += other.moving_dict["elapsed_time"]
-            self.polyline_container.extend(other.polyline_container)
-            self.polyline_str = polyline.encode(self.polyline_container)
+            for key in ("distance", "moving_time", "elapsed_time"):
+                self.moving_dict[key] = sum(
+                    (other.moving_dict[key] for other in others), self.moving_dict[key]
+                )
+            # simplified again, so the merged track stays within max_points
+            self.points = self.points.concat(
+                *(other.points for other in others)
+            ).simplify()
+            self.polyline_str = self.points.encode_polyline()
             self.moving_dict["average_speed"] = (
                 self.moving_dict["distance"]
                 / self.moving_dict["moving_time"].total_seconds()
             )
-            self.file_names.extend(other.file_names)
-            self.special = self.special or other.special
+            for other in others:
+                self.file_names.extend(other.file_names)
+                self.special = self.special or other.special
         except:
             print(
                 f"something wrong append this {self.end_time},in files {str(self.file_names)}"
             )
             pass
 
-    @staticmethod
-    def _get_moving_data(gpx):
-        moving_data = gpx.get_moving_data()
-        return {
+    def _set_moving_data(self, points):
+        """
+        Length and moving_dict from the points, computed the same way for
+        GPX, TCX and FIT. Files whose points have no usable times keep the
+        totals recorded in the file.
+        """
+        moving_data = points.moving_data(STOPPED_SPEED_THRESHOLD)
+        if not moving_data.moving_time and self.moving_dict:
+            return
+        self.length = moving_data.distance
+        self.moving_dict = {
             "distance": moving_data.moving_distance,
             "moving_time": datetime.timedelta(seconds=moving_data.moving_time),
-            "elapsed_time": datetime.timedelta(
-                seconds=(moving_data.moving_time + moving_data.stopped_time)
-            ),
-            "average_speed": (
-                moving_data.moving_distance / moving_data.moving_time
-                if moving_data.moving_time
-                else 0
-            ),
+            "elapsed_time": datetime.timedelta(seconds=moving_data.elapsed_time),
+            "average_speed": moving_data.average_speed,
         }
 
     def to_namedtuple(self):
@@ -353,7 +559,11 @@ class Track:
             "average_heartrate": (
                 int(self.average_heartrate) if self.average_heartrate else None
             ),
-            "map": run_map(self.polyline_str),
+            "map": (
+                run_map(self.polyline_str, SIMPLIFY_TOLERANCE, SIMPLIFY_MAX_POINTS)
+                if self.polyline_str
+                else run_map("")
+            ),
             "start_latlng": self.start_latlng,
             "source": self.source,
         }
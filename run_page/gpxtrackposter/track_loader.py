@@ -6,57 +6,124 @@
 # Use of this source code is governed by a MIT-style
 # license that can be found in the LICENSE file.
 
+import heapq
+import itertools
 import logging
+import math
 import os
 import sys
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 import concurrent.futures
 
+from config import config
 from generator.db import Activity, init_db
+from generator.manifest import DirectoryManifest
+from generator.track_cache import TrackCache
+from polyline_simplifier import SIMPLIFY_MAX_POINTS, SIMPLIFY_TOLERANCE
+from sqlalchemy.orm import selectinload
 
 from .exceptions import ParameterError, TrackLoadError
-from .track import Track
+from .track import STOPPED_SPEED_THRESHOLD, Track
 from .year_range import YearRange
 
-from synced_data_file_logger import load_synced_file_list
-
 log = logging.getLogger(__name__)
 
+# GPX_LOADER=gpxpy falls back to parsing every GPX file into a gpxpy object tree
+GPX_LOADER = os.getenv("GPX_LOADER", "stream")
+# TCX_LOADER=tcxreader falls back to tcxreader.TCXReader for TCX files
+TCX_LOADER = os.getenv("TCX_LOADER", "stream")
+# FIT_LOADER=sdk decodes every message of a FIT file with garmin_fit_sdk
+FIT_LOADER = os.getenv("FIT_LOADER", "fast")
+# bump when Track.to_summary() or the loaders change what they produce,
+# cached summaries with another signature are parsed again
+TRACK_SUMMARY_VERSION = 3
+CACHE_SIGNATURE = (
+    f"{TRACK_SUMMARY_VERSION}/{STOPPED_SPEED_THRESHOLD}"
+    f"/{SIMPLIFY_TOLERANCE}/{SIMPLIFY_MAX_POINTS}"
+)
+# processes parsing files, unset for one per CPU
+LOADER_WORKERS = config("loader", "workers")
+# average files per task sent to a process, unset to pick one from the
+# number of files and workers
+LOADER_CHUNK_SIZE = config("loader", "chunk_size")
+# the most files per task when the chunk size is picked automatically
+MAX_AUTO_CHUNK_SIZE = 64
+# chunks per worker submitted or done but not consumed yet
+CHUNKS_IN_FLIGHT = 2
+# parsed files between two commits of the track cache
+CACHE_COMMIT_EVERY = 500
+
 
 def load_gpx_file(file_name):
     """Load an individual GPX file as a track by using Track.load_gpx()"""
     t = Track()
-    t.load_gpx(file_name)
+    t.load_gpx(file_name, streaming=GPX_LOADER != "gpxpy")
     return t
 
 
 def load_tcx_file(file_name):
     """Load an individual TCX file as a track by using Track.load_tcx()"""
     t = Track()
-    t.load_tcx(file_name)
+    t.load_tcx(file_name, streaming=TCX_LOADER != "tcxreader")
     return t
 
 
 def load_fit_file(file_name):
     """Load an individual FIT file as a track by using Track.load_fit()"""
     t = Track()
-    t.load_fit(file_name)
+    t.load_fit(file_name, fast=FIT_LOADER != "sdk")
     return t
 
 
+def load_chunk(load_func, file_names):
+    """
+    Load file_names in a worker process. Only (file name, Track.to_summary()
+    or None, error) goes back through the result pipe, not the Track objects.
+    """
+    results = []
+    for file_name in file_names:
+        try:
+            results.append((file_name, load_func(file_name).to_summary(), None))
+        except TrackLoadError as e:
+            results.append((file_name, None, str(e)))
+    return results
+
+
+def size_balanced_chunks(file_names, chunk_size):
+    """
+    Split file_names into len / chunk_size chunks of about the same total
+    file size, largest files first, so no process gets all the big ones.
+    """
+    sizes = {file_name: os.path.getsize(file_name) for file_name in file_names}
+    count = math.ceil(len(file_names) / chunk_size)
+    # (total size, chunk index, files), the smallest chunk takes the next file
+    heap = [(0, i, []) for i in range(count)]
+    for file_name in sorted(file_names, key=sizes.get, reverse=True):
+        total, i, files = heapq.heappop(heap)
+        files.append(file_name)
+        heapq.heappush(heap, (total + sizes[file_name], i, files))
+    return [files for _, _, files in sorted(heap, reverse=True)]
+
+
 class TrackLoader:
     """
     Attributes:
         min_length: All tracks shorter than this value are filtered out.
         special_file_names: Tracks marked as special in command line args
         year_range: All tracks outside of this range will be filtered out.
+        cache: TrackCache of parsed file summaries, None to parse every file
+        workers: processes parsing files, None for one per CPU
+        chunk_size: average files per task, None to pick one
 
     Methods:
         load_tracks: Load all data from GPX files
+        iter_tracks: Yield the track of every file to import as it is loaded
+        keep_track: Whether a track passes the filters of load_tracks
+        merge_groups: The tracks load_tracks merges into one
     """
 
-    def __init__(self):
+    def __init__(self, cache_file=None, workers=None, chunk_size=None):
         self.min_length = 100
         self.special_file_names = []
         self.year_range = YearRange()
@@ -65,21 +132,14 @@ class TrackLoader:
             "tcx": load_tcx_file,
             "fit": load_fit_file,
         }
+        self.cache = TrackCache(cache_file, CACHE_SIGNATURE) if cache_file else None
+        self.workers = workers or LOADER_WORKERS or os.cpu_count() or 1
+        self.chunk_size = chunk_size or LOADER_CHUNK_SIZE
 
     def load_tracks(self, data_dir, file_suffix):
         """Load tracks data_dir and return as a List of tracks"""
-        file_names = [x for x in self._list_data_files(data_dir, file_suffix)]
-        print(f"{file_suffix.upper()} files: {len(file_names)}")
-
-        tracks = []
-
-        loaded_tracks = self._load_data_tracks(
-            file_names, self.load_func_dict.get(file_suffix, load_gpx_file)
-        )
-
-        tracks.extend(loaded_tracks.values())
-        log.info(f"Conventionally loaded tracks: {len(loaded_tracks)}")
-
+        file_names = self._list_data_files(data_dir, file_suffix)
+        tracks = [t for _, t in self.iter_tracks(file_names, file_suffix)]
         tracks = self._filter_tracks(tracks)
 
         # merge tracks that took place within one hour
@@ -87,12 +147,67 @@ class TrackLoader:
         # filter out tracks with length < min_length
         return [t for t in tracks if t.length >= self.min_length]
 
+    def iter_tracks(self, file_names, file_suffix):
+        """
+        Yield (file name, Track) for every one of file_names, the cached ones
+        first and then the parsed ones as their chunks finish. Parsed
+        summaries go to the cache, committed every CACHE_COMMIT_EVERY files so
+        an interrupted run keeps what it parsed.
+        """
+        to_parse, unchanged = self._check_cache(file_names)
+
+        if self.cache:
+            hits = 0
+            for file_name, summary in self.cache.summaries(unchanged):
+                if summary is None:
+                    to_parse.append(file_name)
+                    continue
+                hits += 1
+                yield file_name, self._summary_track(summary)
+            print(f"track cache: {hits} hits, {len(to_parse)} files to parse")
+
+        loaded = 0
+        for file_name, summary in self._load_data_tracks(
+            to_parse, self.load_func_dict.get(file_suffix, load_gpx_file)
+        ):
+            if self.cache:
+                self.cache.put(file_name, summary)
+                if loaded % CACHE_COMMIT_EVERY == CACHE_COMMIT_EVERY - 1:
+                    self.cache.commit()
+            loaded += 1
+            yield file_name, self._summary_track(summary)
+        if self.cache:
+            self.cache.commit()
+        log.info(f"Conventionally loaded tracks: {loaded}")
+
+    def reload_tracks(self, file_names, file_suffix):
+        """
+        Tracks of file_names that iter_tracks() yielded before, from the cache
+        or parsed again when there is none.
+        """
+        if self.cache:
+            summaries = self.cache.summaries(file_names)
+        else:
+            load_func = self.load_func_dict.get(file_suffix, load_gpx_file)
+            summaries = (
+                (file_name, load_func(file_name).to_summary())
+                for file_name in file_names
+            )
+        return [self._summary_track(summary) for _, summary in summaries]
+
+    @staticmethod
+    def _summary_track(summary):
+        t = Track()
+        t.load_from_summary(summary)
+        return t
+
     def load_tracks_from_db(self, sql_file, is_grid=False, is_circular=False):
         session = init_db(sql_file)
         if is_grid:
             activities = (
                 session.query(Activity)
-                .filter(Activity.summary_polyline != "")
+                .options(selectinload(Activity.geometry))
+                .filter(Activity.geometry.has())
                 .filter(Activity.type.not_in(["Flight"]))
                 .order_by(Activity.start_date_local)
             )
@@ -111,7 +226,8 @@ class TrackLoader:
         tracks = []
         for activity in activities:
             t = Track()
-            t.load_from_db(activity)
+            # only the grid poster draws the tracks
+            t.load_from_db(activity, with_geometry=is_grid)
             tracks.append(t)
         print(f"All tracks: {len(tracks)}")
         tracks = self._filter_tracks(tracks)
@@ -121,73 +237,117 @@ class TrackLoader:
         return [t for t in tracks if t.length >= self.min_length]
 
     def _filter_tracks(self, tracks):
-        filtered_tracks = []
-        for t in tracks:
-            file_name = t.file_names[0]
-            if int(t.length) == 0:
-                log.info(f"{file_name}: skipping empty track")
-            elif not t.start_time_local:
-                log.info(f"{file_name}: skipping track without start time")
-            elif not self.year_range.contains(t.start_time_local):
-                log.info(
-                    f"{file_name}: skipping track with wrong year {t.start_time_local.year}"
-                )
+        return [t for t in tracks if self.keep_track(t)]
+
+    def keep_track(self, t):
+        """False, and why in the log, for a track that is not imported."""
+        file_name = t.file_names[0]
+        if int(t.length) == 0:
+            log.info(f"{file_name}: skipping empty track")
+        elif not t.start_time_local:
+            log.info(f"{file_name}: skipping track without start time")
+        elif not self.year_range.contains(t.start_time_local):
+            log.info(
+                f"{file_name}: skipping track with wrong year {t.start_time_local.year}"
+            )
+        else:
+            t.special = file_name in self.special_file_names
+            return True
+        return False
+
+    def _check_cache(self, file_names):
+        """
+        Split file_names into the files to parse and the files whose summary
+        may be in the cache.
+        """
+        if not self.cache:
+            return list(file_names), []
+        to_parse, unchanged = [], []
+        for file_name in file_names:
+            if self.cache.state(file_name) == "changed":
+                to_parse.append(file_name)
             else:
-                t.special = file_name in self.special_file_names
-                filtered_tracks.append(t)
-        return filtered_tracks
+                unchanged.append(file_name)
+        self.cache.commit()
+        return to_parse, unchanged
 
     @staticmethod
-    def _merge_tracks(tracks):
-        log.info("Merging tracks...")
-        tracks = sorted(tracks, key=lambda t1: t1.start_time_local)
-        merged_tracks = []
+    def merge_groups(tracks):
+        """
+        Lists of the tracks that _merge_tracks() joins, in start time order.
+        Anything with start_time_local, end_time_local and type can be grouped.
+        """
+        groups = []
         last_end_time = None
-        for t in tracks:
-            if last_end_time is None:
-                merged_tracks.append(t)
-            else:
+        for t in sorted(tracks, key=lambda t1: t1.start_time_local):
+            if last_end_time is not None:
                 dt = (t.start_time_local - last_end_time).total_seconds()
-                if 0 < dt < 3600 and merged_tracks[-1].type == t.type:
-                    merged_tracks[-1].append(t)
-                else:
-                    merged_tracks.append(t)
+                if 0 < dt < 3600 and groups[-1][0].type == t.type:
+                    groups[-1].append(t)
+                    last_end_time = t.end_time_local
+                    continue
+            groups.append([t])
             last_end_time = t.end_time_local
+        return groups
+
+    @classmethod
+    def _merge_tracks(cls, tracks):
+        log.info("Merging tracks...")
+        merged_tracks = []
+        for group in cls.merge_groups(tracks):
+            group[0].merge(group[1:])
+            merged_tracks.append(group[0])
         log.info(f"Merged {len(tracks) - len(merged_tracks)} track(s)")
         return merged_tracks
 
-    @staticmethod
-    def _load_data_tracks(file_names, load_func=load_gpx_file):
+    def _load_data_tracks(self, file_names, load_func=load_gpx_file):
         """
-        TODO refactor with _load_tcx_tracks
+        Parse file_names in size balanced chunks on a process pool and yield
+        (file name, Track.to_summary()) as soon as each chunk is done. At most
+        CHUNKS_IN_FLIGHT chunks per worker are submitted at a time.
         """
-        tracks = {}
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            future_to_file_name = {
-                executor.submit(load_func, file_name): file_name
-                for file_name in file_names
-            }
-        for future in concurrent.futures.as_completed(future_to_file_name):
-            file_name = future_to_file_name[future]
-            try:
-                t = future.result()
-            except TrackLoadError as e:
-                log.error(f"Error while loading {file_name}: {e}")
-            else:
-                tracks[file_name] = t
-        return tracks
+        if not file_names:
+            return
+        workers = min(self.workers, len(file_names))
+        chunk_size = self.chunk_size or max(
+            1, min(MAX_AUTO_CHUNK_SIZE, math.ceil(len(file_names) / (workers * 4)))
+        )
+        chunks = size_balanced_chunks(file_names, chunk_size)
+        if workers == 1:
+            # no pool to start and nothing to pickle
+            results = (load_chunk(load_func, chunk) for chunk in chunks)
+            yield from self._loaded_summaries(results)
+            return
+        chunks = iter(chunks)
+        pending = set()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            while True:
+                # a slow consumer stalls the pool instead of piling up results
+                for chunk in itertools.islice(
+                    chunks, workers * CHUNKS_IN_FLIGHT - len(pending)
+                ):
+                    pending.add(executor.submit(load_chunk, load_func, chunk))
+                if not pending:
+                    break
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                yield from self._loaded_summaries(future.result() for future in done)
+
+    @staticmethod
+    def _loaded_summaries(results):
+        for chunk_results in results:
+            for file_name, summary, error in chunk_results:
+                if error is not None:
+                    log.error(f"Error while loading {file_name}: {error}")
+                else:
+                    yield file_name, summary
 
     @staticmethod
     def _list_data_files(data_dir, file_suffix):
-        synced_files = load_synced_file_list()
-        data_dir = os.path.abspath(data_dir)
-        if not os.path.isdir(data_dir):
-            raise ParameterError(f"Not a directory: {data_dir}")
-        for name in os.listdir(data_dir):
-            if name.startswith("."):
-                continue
-            if name in synced_files:
-                continue
-            path_name = os.path.join(data_dir, name)
-            if name.endswith(f".{file_suffix}") and os.path.isfile(path_name):
-                yield path_name
+        manifest = DirectoryManifest(data_dir)
+        if not os.path.isdir(manifest.folder):
+            raise ParameterError(f"Not a directory: {manifest.folder}")
+        return [
+            os.path.join(manifest.folder, name) for name in manifest.names(file_suffix)
+        ]
@@ -0,0 +1,215 @@
+"""Columnar storage for the points of a track."""
+
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import datetime
+from collections import namedtuple
+
+import numpy as np
+import polyline_codec
+import polyline_simplifier
+
+from .geo import BBox, haversine
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+# marks a point without a time in TrackPoints.times
+NO_TIME = -(2**63)
+
+MovingData = namedtuple(
+    "MovingData",
+    "distance moving_distance moving_time stopped_time elapsed_time average_speed",
+)
+
+
+def datetime_to_micros(time):
+    """Microseconds since the epoch, naive datetimes are taken as UTC."""
+    if time is None:
+        return NO_TIME
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=datetime.timezone.utc)
+    return (time - EPOCH) // ONE_MICROSECOND
+
+
+class TrackPoints:
+    """
+    The points of a track as one numpy array per value, instead of a list of
+    Python objects per point. Tracks are pickled back from the loader
+    processes, so this keeps them small.
+
+    Attributes:
+        lats, lons: float64 degrees
+        times: int64 microseconds since the epoch, NO_TIME when missing
+        elevations: float64 meters, NaN when missing
+        heart_rates: int64 bpm, 0 when missing
+        segment_starts: index of the first point of every segment
+
+    Methods:
+        segments: one slice of the arrays per segment
+        latlngs: [[lat, lon], ...] as plain floats
+        encode_polyline: the points as an encoded polyline string
+        simplify: the points polyline_simplifier keeps, segments kept apart
+        s2_lines: one list of s2.LatLng per segment
+        bbox: the smallest geo.BBox containing all points
+        concat: a new TrackPoints with the points of other after these
+        distances: meters from every point to the next one
+        moving_data: distances and moving/stopped time of the whole track
+    """
+
+    __slots__ = (
+        "lats",
+        "lons",
+        "times",
+        "elevations",
+        "heart_rates",
+        "segment_starts",
+    )
+
+    def __init__(
+        self,
+        lats=(),
+        lons=(),
+        times=None,
+        elevations=None,
+        heart_rates=None,
+        segment_starts=None,
+    ):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        size = len(self.lats)
+        self.times = (
+            np.full(size, NO_TIME, dtype=np.int64)
+            if times is None
+            else np.asarray(times, dtype=np.int64)
+        )
+        self.elevations = (
+            np.full(size, np.nan)
+            if elevations is None
+            else np.asarray(elevations, dtype=np.float64)
+        )
+        self.heart_rates = (
+            np.zeros(size, dtype=np.int64)
+            if heart_rates is None
+            else np.asarray(heart_rates, dtype=np.int64)
+        )
+        if segment_starts is None:
+            segment_starts = [0] if size else []
+        self.segment_starts = np.asarray(segment_starts, dtype=np.int64)
+
+    @classmethod
+    def from_latlngs(cls, latlngs, **kwargs):
+        latlngs = np.asarray(latlngs, dtype=np.float64).reshape(-1, 2)
+        return cls(latlngs[:, 0], latlngs[:, 1], **kwargs)
+
+    def __len__(self):
+        return len(self.lats)
+
+    def segments(self):
+        ends = np.append(self.segment_starts[1:], len(self))
+        for start, end in zip(self.segment_starts.tolist(), ends.tolist()):
+            yield slice(start, end)
+
+    def first(self):
+        if not len(self):
+            return None
+        return float(self.lats[0]), float(self.lons[0])
+
+    def latlngs(self):
+        return np.column_stack((self.lats, self.lons)).tolist()
+
+    def encode_polyline(self):
+        return polyline_codec.encode(np.column_stack((self.lats, self.lons)))
+
+    def simplify(
+        self,
+        tolerance=polyline_simplifier.SIMPLIFY_TOLERANCE,
+        max_points=polyline_simplifier.SIMPLIFY_MAX_POINTS,
+    ):
+        keep = np.flatnonzero(
+            polyline_simplifier.simplify_mask(
+                self.lats, self.lons, self.segment_starts, tolerance, max_points
+            )
+        )
+        return TrackPoints(
+            self.lats[keep],
+            self.lons[keep],
+            self.times[keep],
+            self.elevations[keep],
+            self.heart_rates[keep],
+            np.searchsorted(keep, self.segment_starts),
+        )
+
+    def s2_lines(self):
+        import s2sphere as s2
+
+        return [
+            [
+                s2.LatLng.from_degrees(lat, lon)
+                for lat, lon in zip(self.lats[s].tolist(), self.lons[s].tolist())
+            ]
+            for s in self.segments()
+        ]
+
+    def bbox(self):
+        return BBox.from_points(self.lats, self.lons)
+
+    def _in_segment(self):
+        """True for every pair of consecutive points in the same segment."""
+        in_segment = np.ones(max(len(self) - 1, 0), dtype=bool)
+        starts = self.segment_starts
+        in_segment[starts[(starts > 0) & (starts < len(self))] - 1] = False
+        return in_segment
+
+    def distances(self):
+        """Meters from every point to the next one, 0 across segment breaks."""
+        distances = haversine(
+            self.lats[:-1], self.lons[:-1], self.lats[1:], self.lons[1:]
+        )
+        distances[~self._in_segment()] = 0
+        return distances
+
+    def cumulative_distance(self):
+        return np.concatenate(([0.0], np.cumsum(self.distances())))
+
+    def moving_data(self, stopped_speed_threshold=1):
+        """
+        Split the time between consecutive points into moving and stopped,
+        a step slower than stopped_speed_threshold (km/h) counts as stopped.
+        """
+        distances = self.distances()
+        start, end = self.times[:-1], self.times[1:]
+        timed = (start != NO_TIME) & (end != NO_TIME) & self._in_segment()
+        seconds = np.zeros(len(distances))
+        seconds[timed] = (end[timed] - start[timed]) / 10**6
+        timed &= seconds > 0
+        speed = np.zeros(len(distances))
+        speed[timed] = distances[timed] / seconds[timed] * 3.6
+        moving = timed & (speed > stopped_speed_threshold)
+        stopped = timed & ~moving
+        moving_time = float(seconds[moving].sum())
+        moving_distance = float(distances[moving].sum())
+        times = self.times[self.times != NO_TIME]
+        return MovingData(
+            distance=float(distances.sum()),
+            moving_distance=moving_distance,
+            moving_time=moving_time,
+            stopped_time=float(seconds[stopped].sum()),
+            elapsed_time=float(times[-1] - times[0]) / 10**6 if len(times) else 0.0,
+            average_speed=moving_distance / moving_time if moving_time else 0,
+        )
+
+    def concat(self, *others):
+        """These points followed by the points of others, copied once."""
+        parts = (self,) + others
+        offsets = np.cumsum([0] + [len(p) for p in parts[:-1]])
+        return TrackPoints(
+            np.concatenate([p.lats for p in parts]),
+            np.concatenate([p.lons for p in parts]),
+            np.concatenate([p.times for p in parts]),
+            np.concatenate([p.elevations for p in parts]),
+            np.concatenate([p.heart_rates for p in parts]),
+            np.concatenate(
+                [p.segment_starts + offset for p, offset in zip(parts, offsets)]
+            ),
+        )
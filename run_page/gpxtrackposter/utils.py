@@ -7,32 +7,19 @@
 
 import locale
 import math
-from datetime import datetime
 from typing import List, Optional, Tuple
 
 import colour
-import pytz
-import s2sphere as s2
-
-try:
-    from tzfpy import get_tz
-
-    tf = None
-except:
-    from timezonefinder import TimezoneFinder
-
-    tf = TimezoneFinder()
-
+import numpy as np
+import timezone_resolver
 
+from .geo import BBox, mercator
+from .track_points import TrackPoints
 from .value_range import ValueRange
 from .xy import XY
 
 
 # mercator projection
-def latlng2xy(latlng: s2.LatLng) -> XY:
-    return XY(lng2x(latlng.lng().degrees), lat2y(latlng.lat().degrees))
-
-
 def lng2x(lng_deg: float) -> float:
     return lng_deg / 180 + 1
 
@@ -42,16 +29,16 @@ def lat2y(lat_deg: float) -> float:
 
 
 def project(
-    bbox: s2.LatLngRect, size: XY, offset: XY, latlnglines: List[List[s2.LatLng]]
+    bbox: BBox, size: XY, offset: XY, points: TrackPoints
 ) -> List[List[Tuple[float, float]]]:
-    min_x = lng2x(bbox.lng_lo().degrees)
-    d_x = lng2x(bbox.lng_hi().degrees) - min_x
+    min_x = lng2x(bbox.lng_lo)
+    d_x = lng2x(bbox.lng_hi) - min_x
     while d_x >= 2:
         d_x -= 2
     while d_x < 0:
         d_x += 2
-    min_y = lat2y(bbox.lat_lo().degrees)
-    max_y = lat2y(bbox.lat_hi().degrees)
+    min_y = lat2y(bbox.lat_lo)
+    max_y = lat2y(bbox.lat_hi)
     d_y = abs(max_y - min_y)
     # the distance maybe zero
     if d_x == 0 or d_y == 0:
@@ -61,19 +48,17 @@ def project(
     lines = []
     # If len > $zoom_threshold, choose 1 point out of every $step to reduce size of the SVG file
     zoom_threshold = 400
-    for latlngline in latlnglines:
-        line = []
-        step = int(len(latlngline) / zoom_threshold) + 1
-        for i in range(0, len(latlngline), step):
-            latlng = latlngline[i]
-            if bbox.contains(latlng):
-                line.append((offset + scale * latlng2xy(latlng)).tuple())
-            else:
-                if len(line) > 0:
-                    lines.append(line)
-                    line = []
-        if len(line) > 0:
-            lines.append(line)
+    for segment in points.segments():
+        lats, lons = points.lats[segment], points.lons[segment]
+        step = int(len(lats) / zoom_threshold) + 1
+        lats, lons = lats[::step], lons[::step]
+        x, y = mercator(lats, lons)
+        xy = np.column_stack((offset.x + scale * x, offset.y + scale * y))
+        # points outside of bbox split the line
+        inside = bbox.contains(lats, lons)
+        runs = np.flatnonzero(np.diff(np.concatenate(([0], inside, [0]))))
+        for start, end in zip(runs[::2].tolist(), runs[1::2].tolist()):
+            lines.append([tuple(p) for p in xy[start:end].tolist()])
     return lines
 
 
@@ -131,18 +116,12 @@ def format_float(f):
 
 def parse_datetime_to_local(start_time, end_time, point):
     if not point:
-        timezone = "Asia/Shanghai"
+        timezone = timezone_resolver.DEFAULT_ZONE
     else:
         # just parse the start time, because start/end maybe different
         offset = start_time.utcoffset()
         if offset:
             return start_time + offset, end_time + offset
-        lat, lng = point
-        try:
-            timezone = get_tz(lng=lng, lat=lat)
-        except:
-            # just a little trick when tzfpy support windows will delete this
-            lat, lng = point
-            timezone = tf.timezone_at(lng=lng, lat=lat)
-    tc_offset = datetime.now(pytz.timezone(timezone)).utcoffset()
+        timezone = timezone_resolver.zone_at(*point)
+    tc_offset = timezone_resolver.utc_offset(timezone, start_time)
     return start_time + tc_offset, end_time + tc_offset
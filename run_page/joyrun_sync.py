@@ -1,6 +1,5 @@
 # some code from https://github.com/fieryd/PKURunningHelper great thanks
 import argparse
-import json
 import os
 import time
 from collections import namedtuple
@@ -9,10 +8,11 @@ from hashlib import md5
 from urllib.parse import quote
 
 import gpxpy
-import polyline
+import polyline_simplifier
 import requests
-from config import BASE_TIMEZONE, GPX_FOLDER, JSON_FILE, SQL_FILE, run_map, start_point
+from config import BASE_TIMEZONE, GPX_FOLDER, JSON_FILE, SQL_FILE, start_point
 from generator import Generator
+from generator.manifest import DirectoryManifest
 
 from utils import adjust_time
 
@@ -285,7 +285,6 @@ class Joyrun:
             if heart_rate < 0:
                 heart_rate = None
 
-        polyline_str = polyline.encode(run_points_data) if run_points_data else ""
         start_latlng = start_point(*run_points_data[0]) if run_points_data else None
         start_date = datetime.utcfromtimestamp(start_time)
         start_date_local = adjust_time(start_date, BASE_TIMEZONE)
@@ -309,7 +308,7 @@ class Joyrun:
             "end_local": datetime.strftime(end_local, "%Y-%m-%d %H:%M:%S"),
             "length": run_data["meter"],
             "average_heartrate": heart_rate,
-            "map": run_map(polyline_str),
+            "map": polyline_simplifier.simplified_map(run_points_data),
             "start_latlng": start_latlng,
             "distance": run_data["meter"],
             "moving_time": timedelta(seconds=run_data["second"]),
@@ -322,13 +321,11 @@ class Joyrun:
         }
         return namedtuple("x", d.keys())(*d.values())
 
-    def get_all_joyrun_tracks(self, old_tracks_ids, with_gpx=False):
+    def get_all_joyrun_tracks(self, sync_state, with_gpx=False):
         run_ids = self.get_runs_records_ids()
-        old_tracks_ids = [int(i) for i in old_tracks_ids if i.isdigit()]
 
-        old_gpx_ids = os.listdir(GPX_FOLDER)
-        old_gpx_ids = [i.split(".")[0] for i in old_gpx_ids if not i.startswith(".")]
-        new_run_ids = list(set(run_ids) - set(old_tracks_ids))
+        old_gpx_ids = DirectoryManifest(GPX_FOLDER).ids()
+        new_run_ids = [i for i in set(run_ids) if i not in sync_state]
         tracks = []
         for i in new_run_ids:
             run_data = self.get_single_run_record(i)
@@ -369,9 +366,8 @@ if __name__ == "__main__":
         j.login_by_phone()
 
     generator = Generator(SQL_FILE)
-    old_tracks_ids = generator.get_old_tracks_ids()
-    tracks = j.get_all_joyrun_tracks(old_tracks_ids, options.with_gpx)
-    generator.sync_from_app(tracks)
-    activities_list = generator.load()
-    with open(JSON_FILE, "w") as f:
-        json.dump(activities_list, f, indent=0)
+    sync_state = generator.sync_state("joyrun", activity_source="Joyrun")
+    tracks = j.get_all_joyrun_tracks(sync_state, options.with_gpx)
+    sync_state.update(generator.sync_from_app(tracks))
+    sync_state.save()
+    generator.export_json(JSON_FILE)
@@ -9,11 +9,12 @@ from datetime import datetime, timedelta
 
 import eviltransform
 import gpxpy
-import polyline
+import polyline_simplifier
 import requests
-from config import GPX_FOLDER, JSON_FILE, SQL_FILE, run_map, start_point
+from config import GPX_FOLDER, JSON_FILE, SQL_FILE, start_point
 from Crypto.Cipher import AES
 from generator import Generator
+from generator.manifest import DirectoryManifest
 from utils import adjust_time
 import xml.etree.ElementTree as ET
 
@@ -127,7 +128,6 @@ def parse_raw_data_to_nametuple(
                 download_keep_gpx(gpx_data, str(keep_id))
     else:
         print(f"ID {keep_id} no gps data")
-    polyline_str = polyline.encode(run_points_data) if run_points_data else ""
     start_latlng = start_point(*run_points_data[0]) if run_points_data else None
     start_date = datetime.utcfromtimestamp(start_time / 1000)
     tz_name = run_data.get("timezone", "")
@@ -148,7 +148,7 @@ def parse_raw_data_to_nametuple(
         "end_local": datetime.strftime(end_local, "%Y-%m-%d %H:%M:%S"),
         "length": run_data["distance"],
         "average_heartrate": int(avg_heart_rate) if avg_heart_rate else None,
-        "map": run_map(polyline_str),
+        "map": polyline_simplifier.simplified_map(run_points_data),
         "start_latlng": start_latlng,
         "distance": run_data["distance"],
         "moving_time": timedelta(seconds=run_data["duration"]),
@@ -162,17 +162,16 @@ def parse_raw_data_to_nametuple(
     return namedtuple("x", d.keys())(*d.values())
 
 
-def get_all_keep_tracks(email, password, old_tracks_ids, with_download_gpx=False):
+def get_all_keep_tracks(email, password, sync_state, with_download_gpx=False):
     if with_download_gpx and not os.path.exists(GPX_FOLDER):
         os.mkdir(GPX_FOLDER)
     s = requests.Session()
     s, headers = login(s, email, password)
     runs = get_to_download_runs_ids(s, headers)
-    runs = [run for run in runs if run.split("_")[1] not in old_tracks_ids]
+    runs = [run for run in runs if run.split("_")[1] not in sync_state]
     print(f"{len(runs)} new keep runs to generate")
     tracks = []
-    old_gpx_ids = os.listdir(GPX_FOLDER)
-    old_gpx_ids = [i.split(".")[0] for i in old_gpx_ids if not i.startswith(".")]
+    old_gpx_ids = DirectoryManifest(GPX_FOLDER).ids()
     for run in runs:
         print(f"parsing keep id {run}")
         try:
@@ -300,13 +299,12 @@ def download_keep_gpx(gpx_data, keep_id):
 
 def run_keep_sync(email, password, with_download_gpx=False):
     generator = Generator(SQL_FILE)
-    old_tracks_ids = generator.get_old_tracks_ids()
-    new_tracks = get_all_keep_tracks(email, password, old_tracks_ids, with_download_gpx)
-    generator.sync_from_app(new_tracks)
+    sync_state = generator.sync_state("keep", activity_source="Keep")
+    new_tracks = get_all_keep_tracks(email, password, sync_state, with_download_gpx)
+    sync_state.update(generator.sync_from_app(new_tracks))
+    sync_state.save()
 
-    activities_list = generator.load()
-    with open(JSON_FILE, "w") as f:
-        json.dump(activities_list, f, indent=0)
+    generator.export_json(JSON_FILE)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,7 @@
-import json
 from datetime import datetime, timedelta
 
 import eviltransform
-import polyline
+import polyline_simplifier
 from config import JSON_FILE, SQL_FILE
 from fastkml import kml
 from generator import Generator
@@ -54,7 +53,7 @@ def load_kml_data(track, k):
         ]
 
     track.start_latlng = start_point(polyline_container[0][0], polyline_container[0][1])
-    track.polyline_str = polyline.encode(polyline_container)
+    track.polyline_str = polyline_simplifier.encode(polyline_container)
     return track
 
 
@@ -82,6 +81,4 @@ if __name__ == "__main__":
     # save
     generator = Generator(SQL_FILE)
     generator.sync_from_kml_track(track)
-    activities_list = generator.loadForMapping()
-    with open(JSON_FILE, "w") as json_file:
-        json.dump(activities_list, json_file, indent=0)
+    generator.export_json(JSON_FILE, for_mapping=True)
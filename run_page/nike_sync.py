@@ -19,6 +19,7 @@ from config import (
     run_map,
 )
 from generator import Generator
+from generator.manifest import DirectoryManifest
 
 from utils import adjust_time, make_activities_file
 
@@ -135,10 +136,7 @@ def save_activity(activity):
 
 def get_last_id():
     try:
-        file_names = os.listdir(OUTPUT_DIR)
-        file_names = [i for i in file_names if not i.startswith(".")]
-        file_names.sort()
-        file_name = file_names[-1]
+        file_name = DirectoryManifest(OUTPUT_DIR).names()[-1]
         with open(os.path.join(OUTPUT_DIR, file_name)) as f:
             data = json.load(f)
         logger.info(f"Last update from {data['id']}")
@@ -169,15 +167,13 @@ def sanitise_json(d):
 
 
 def get_to_generate_files():
-    file_names = os.listdir(GPX_FOLDER)
+    file_names = DirectoryManifest(GPX_FOLDER).names()
     try:
         # error when mixed keep & nike gpx files
         # since keep has gpx files like 9223370434827882207.gpx
         # so we need to check gpx file name ensure it is a valid timestamp
         timestamps = []
         for i in file_names:
-            if i.startswith("."):
-                continue
             t = int(i.split(".")[0])
             # the follow 7226553600000 representing the timestamp(with millisecond)
             # for "Tue Jan 01 2199 00:00:00 GMT+0800 (CST)"
@@ -194,8 +190,8 @@ def get_to_generate_files():
         last_time = 0
     return [
         OUTPUT_DIR + "/" + i
-        for i in os.listdir(OUTPUT_DIR)
-        if not i.startswith(".") and int(i.split(".")[0]) > last_time
+        for i in DirectoryManifest(OUTPUT_DIR).names()
+        if int(i.split(".")[0]) > last_time
     ]
 
 
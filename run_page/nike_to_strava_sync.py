@@ -4,6 +4,7 @@ import time
 from datetime import datetime, timedelta
 
 from config import OUTPUT_DIR
+from generator.manifest import DirectoryManifest
 from nike_sync import make_new_gpxs, run
 from strava_sync import run_strava_sync
 
@@ -11,11 +12,11 @@ from utils import make_strava_client, get_strava_last_time, upload_file_to_strav
 
 
 def get_to_generate_files(last_time):
-    file_names = os.listdir(OUTPUT_DIR)
+    file_names = DirectoryManifest(OUTPUT_DIR).names("json")
     return [
         os.path.join(OUTPUT_DIR, i)
         for i in file_names
-        if i.endswith(".json") and int(i.split(".")[0]) > last_time
+        if int(i.split(".")[0]) > last_time
     ]
 
 
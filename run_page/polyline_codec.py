@@ -0,0 +1,80 @@
+"""
+Google's Encoded Polyline Algorithm Format with NumPy.
+
+The same output as the polyline package, byte for byte, but the rounding,
+delta, zigzag and 5 bit varint steps run on whole arrays instead of one
+character at a time:
+
+    encode([(38.5, -120.2), (40.7, -120.95)]) == "_p~iF~ps|U_ulLnnqC"
+    decode("_p~iF~ps|U_ulLnnqC") == [(38.5, -120.2), (40.7, -120.95)]
+
+encode_bytes() and decode_array() skip the str and tuple conversions for
+callers that store bytes or want the coordinates as an (n, 2) array.
+"""
+
+import numpy as np
+
+PRECISION = 5
+# 5 bits per character, enough for any 64 bit value
+SHIFTS = np.arange(0, 64, 5, dtype=np.uint64)
+
+
+def _round(values):
+    # the polyline algorithm rounds half away from zero, like Python 2 did
+    return (np.copysign(np.floor(np.abs(values) + 0.5), values)).astype(np.int64)
+
+
+def encode_bytes(coordinates, precision=PRECISION):
+    """Encode (lat, lon) pairs, a list or an (n, 2) array, into ASCII bytes."""
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    if not len(coordinates):
+        return b""
+    values = coordinates * int(10**precision)
+    if not np.isfinite(values).all():
+        raise ValueError("coordinates must be finite numbers")
+    deltas = np.diff(_round(values), axis=0, prepend=np.zeros((1, 2), np.int64))
+    deltas = deltas.ravel()
+    zigzag = np.where(deltas < 0, ~(deltas << 1), deltas << 1).view(np.uint64)
+    # one column per 5 bit chunk of the largest value
+    shifts = SHIFTS[: int(zigzag.max()).bit_length() // 5 + 1]
+    chunks = zigzag[:, None] >> shifts
+    lengths = np.maximum(np.count_nonzero(chunks, axis=1), 1)
+    columns = np.arange(len(shifts))
+    characters = (chunks & 0x1F).astype(np.uint8) + 63
+    characters[columns < (lengths - 1)[:, None]] += 0x20
+    return characters[columns < lengths[:, None]].tobytes()
+
+
+def encode(coordinates, precision=PRECISION):
+    """Encode (lat, lon) pairs into a polyline string, "" for no points."""
+    return encode_bytes(coordinates, precision).decode("ascii")
+
+
+def decode_array(expression, precision=PRECISION):
+    """Decode a polyline str or bytes into an (n, 2) float64 array of lat, lon."""
+    if isinstance(expression, str):
+        expression = expression.encode("ascii")
+    data = np.frombuffer(expression, dtype=np.uint8).astype(np.int64) - 63
+    if not len(data):
+        return np.empty((0, 2))
+    last = data < 0x20
+    if not last[-1]:
+        raise ValueError("polyline ends in the middle of a value")
+    # index of the value every character belongs to, and its place in it
+    value_index = np.concatenate(([0], np.cumsum(last[:-1])))
+    starts = np.flatnonzero(np.concatenate(([True], last[:-1])))
+    place = np.arange(len(data)) - starts[value_index]
+    if np.any(place >= len(SHIFTS)):
+        raise ValueError("polyline value out of range")
+    bits = (data & 0x1F) << (5 * place)
+    values = np.add.reduceat(bits, starts)
+    if len(values) % 2:
+        raise ValueError("polyline has an odd number of values")
+    deltas = np.where(values & 1, ~(values >> 1), values >> 1)
+    return np.cumsum(deltas.reshape(-1, 2), axis=0) / float(10**precision)
+
+
+def decode(expression, precision=PRECISION):
+    """Decode a polyline into a list of (lat, lon) tuples."""
+    coordinates = decode_array(expression, precision)
+    return list(zip(coordinates[:, 0].tolist(), coordinates[:, 1].tolist()))
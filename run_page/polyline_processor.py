@@ -1,11 +1,15 @@
 from typing import List, Tuple
-import polyline
+import polyline_codec
 import os
-from haversine import haversine
+import numpy as np
+from gpxtrackposter.geo import haversine
+
+# km, the mean radius the haversine package used
+MEAN_EARTH_RADIUS = 6371.0088
 
 try:
     IGNORE_POLYLINE = (
-        polyline.decode(os.getenv("IGNORE_POLYLINE"))
+        polyline_codec.decode(os.getenv("IGNORE_POLYLINE"))
         if os.getenv("IGNORE_POLYLINE")
         else []
     )
@@ -21,44 +25,57 @@ except ValueError:
     exit(1)
 
 
+def _distances(points_a, points_b) -> np.ndarray:
+    """km between every point of points_a and the matching one of points_b."""
+    points_a = np.asarray(points_a, dtype=np.float64).reshape(-1, 2)
+    points_b = np.asarray(points_b, dtype=np.float64).reshape(-1, 2)
+    return haversine(
+        points_a[:, 0],
+        points_a[:, 1],
+        points_b[:, 0],
+        points_b[:, 1],
+        radius=MEAN_EARTH_RADIUS,
+    )
+
+
 def point_distance_in_range(
     point: Tuple[float], center_point: Tuple[float], distance: int
 ) -> bool:
-    return haversine(point, center_point) < distance
+    return bool(_distances(point, center_point)[0] < distance)
 
 
 def point_in_list_points_range(
     point: Tuple[float], points: List[Tuple[float]], distance: int
 ) -> bool:
-    return any([point_distance_in_range(point, p, distance) for p in points])
+    return bool(len(points)) and bool((_distances(point, points) < distance).any())
 
 
 def range_hiding(
     polyline: List[Tuple[float]], points: List[Tuple[float]], distance: int
 ) -> List[Tuple[float]]:
-    return [
-        point
-        for point in polyline
-        if not point_in_list_points_range(point, points, distance)
-    ]
+    if not len(polyline) or not len(points):
+        return list(polyline)
+    polyline_array = np.asarray(polyline, dtype=np.float64).reshape(-1, 1, 2)
+    points_array = np.asarray(points, dtype=np.float64).reshape(1, -1, 2)
+    # one row per polyline point, one column per point to hide around
+    pairs = np.broadcast_arrays(polyline_array, points_array)
+    hidden = (_distances(*pairs).reshape(len(polyline), -1) < distance).any(axis=1)
+    return [point for point, hide in zip(polyline, hidden.tolist()) if not hide]
 
 
 def start_end_hiding(polyline: List[Tuple[float]], distance: int) -> List[Tuple[float]]:
     start_index, end_index = 0, len(polyline) - 1
+    steps = _distances(polyline[1:], polyline[:-1])
 
-    starting_distance = 0
-    for i in range(1, len(polyline)):
-        starting_distance += haversine(polyline[i], polyline[i - 1])
-        if starting_distance > distance:
-            start_index = i
-            break
+    # first point after more than distance from the start
+    beyond = np.flatnonzero(np.cumsum(steps) > distance)
+    if len(beyond):
+        start_index = int(beyond[0]) + 1
 
-    ending_distance = 0
-    for i in range(len(polyline) - 2, -1, -1):
-        ending_distance += haversine(polyline[i], polyline[i + 1])
-        if ending_distance > distance:
-            end_index = i
-            break
+    # last point before more than distance from the end
+    beyond = np.flatnonzero(np.cumsum(steps[::-1]) > distance)
+    if len(beyond):
+        end_index = len(polyline) - 2 - int(beyond[0])
 
     if start_index >= end_index:
         return []
@@ -69,7 +86,7 @@ def start_end_hiding(polyline: List[Tuple[float]], distance: int) -> List[Tuple[
 def filter_out(polyline_str):
     if not polyline_str:
         return
-    pl = polyline.decode(polyline_str)
+    pl = polyline_codec.decode(polyline_str)
     if not pl:
         return polyline_str
 
@@ -78,4 +95,4 @@ def filter_out(polyline_str):
 
     if not new_pl:
         return
-    return polyline.encode(new_pl)
+    return polyline_codec.encode(new_pl)
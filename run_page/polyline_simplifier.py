@@ -0,0 +1,126 @@
+"""
+Douglas-Peucker simplification of tracks before their polyline is encoded.
+
+    polyline_simplifier.encode(points) == polyline_codec.encode(simplify(points))
+
+Every ingest path (GPX/TCX/FIT files, the sync scripts) goes through here, so
+the polylines in data.db and activities.json only keep the points that are
+more than `tolerance` metres away from the simplified line, and at most
+`max_points` of them. Both come from config.yaml:
+
+    polyline:
+      simplify_tolerance: 10
+      max_points: 0
+
+The distances are measured in metres on a local equirectangular projection
+of the track. Splits are made farthest point first across all segments, so
+the max_points cap keeps the points that matter most, and the same points,
+tolerance and cap always give the same result. The settings a polyline was
+made with are stored next to it in activity_geometry.
+"""
+
+import heapq
+
+import numpy as np
+import polyline_codec
+from config import config, run_map
+
+EARTH_RADIUS = 6378.137 * 1000
+
+_tolerance = config("polyline", "simplify_tolerance")
+# metres, 0 only drops points lying exactly on the line
+SIMPLIFY_TOLERANCE = 10.0 if _tolerance is None else float(_tolerance)
+# most points kept per track, 0 means no limit
+SIMPLIFY_MAX_POINTS = int(config("polyline", "max_points") or 0)
+
+
+def _project(lats, lons):
+    """Metres east and north of the equator, scaled at the mean latitude."""
+    scale = np.cos(np.radians(np.mean(lats)))
+    # unwrapped, so tracks across the antimeridian stay continuous
+    x = np.unwrap(np.radians(lons)) * scale * EARTH_RADIUS
+    y = np.radians(lats) * EARTH_RADIUS
+    return x, y
+
+
+def _farthest(x, y, begin, last):
+    """(distance, index) of the point of begin..last farthest from its chord."""
+    px, py = x[begin + 1 : last], y[begin + 1 : last]
+    dx, dy = x[last] - x[begin], y[last] - y[begin]
+    length2 = dx * dx + dy * dy
+    if length2:
+        t = np.clip(((px - x[begin]) * dx + (py - y[begin]) * dy) / length2, 0, 1)
+    else:
+        t = 0.0
+    distances = np.hypot(px - (x[begin] + t * dx), py - (y[begin] + t * dy))
+    i = int(np.argmax(distances))
+    return float(distances[i]), begin + 1 + i
+
+
+def simplify_mask(
+    lats,
+    lons,
+    segment_starts=(0,),
+    tolerance=SIMPLIFY_TOLERANCE,
+    max_points=SIMPLIFY_MAX_POINTS,
+):
+    """
+    Boolean mask of the points to keep. The first and last point of every
+    segment are always kept, even when there are more than max_points of them.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    size = len(lats)
+    keep = np.zeros(size, dtype=bool)
+    if not size:
+        return keep
+    x, y = _project(lats, lons)
+    ends = np.append(np.asarray(segment_starts, dtype=np.int64)[1:], size)
+    heap = []
+    for first, end in zip(np.asarray(segment_starts).tolist(), ends.tolist()):
+        if end <= first:
+            continue
+        keep[first] = keep[end - 1] = True
+        if end - first > 2:
+            distance, pivot = _farthest(x, y, first, end - 1)
+            heap.append((-distance, first, end - 1, pivot))
+    heapq.heapify(heap)
+    kept = int(keep.sum())
+    while heap and (not max_points or kept < max_points):
+        distance, begin, last, pivot = heapq.heappop(heap)
+        if -distance <= tolerance:
+            break
+        keep[pivot] = True
+        kept += 1
+        for begin, last in ((begin, pivot), (pivot, last)):
+            if last - begin > 1:
+                distance, farthest = _farthest(x, y, begin, last)
+                heapq.heappush(heap, (-distance, begin, last, farthest))
+    return keep
+
+
+def simplify(coordinates, tolerance=SIMPLIFY_TOLERANCE, max_points=SIMPLIFY_MAX_POINTS):
+    """The kept (lat, lon) pairs of coordinates as an (n, 2) array."""
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    keep = simplify_mask(
+        coordinates[:, 0],
+        coordinates[:, 1],
+        tolerance=tolerance,
+        max_points=max_points,
+    )
+    return coordinates[keep]
+
+
+def encode(coordinates, tolerance=SIMPLIFY_TOLERANCE, max_points=SIMPLIFY_MAX_POINTS):
+    """Simplify (lat, lon) pairs and encode them, "" for no points."""
+    if coordinates is None or not len(coordinates):
+        return ""
+    return polyline_codec.encode(simplify(coordinates, tolerance, max_points))
+
+
+def simplified_map(coordinates):
+    """run_map of the simplified polyline and the settings it was made with."""
+    polyline = encode(coordinates)
+    if not polyline:
+        return run_map("")
+    return run_map(polyline, SIMPLIFY_TOLERANCE, SIMPLIFY_MAX_POINTS)
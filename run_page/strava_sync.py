@@ -1,5 +1,4 @@
 import argparse
-import json
 
 from config import JSON_FILE, SQL_FILE
 from generator import Generator
@@ -13,9 +12,7 @@ def run_strava_sync(client_id, client_secret, refresh_token, only_run=False):
     generator.only_run = only_run
     generator.sync(False)
 
-    activities_list = generator.loadForMapping()
-    with open(JSON_FILE, "w") as f:
-        json.dump(activities_list, f, indent=0)
+    generator.export_json(JSON_FILE, for_mapping=True)
 
 
 if __name__ == "__main__":
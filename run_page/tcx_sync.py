@@ -3,10 +3,31 @@ If you do not want bind any account
 Only the gpx files in GPX_OUT sync
 """
 
+import argparse
+
 from config import JSON_FILE, SQL_FILE, TCX_FOLDER
 
-from utils import make_activities_file
+from utils import add_loader_args, make_activities_file, watch_activities_file
 
 if __name__ == "__main__":
     print("only sync tcx files in TCX_OUT")
-    make_activities_file(SQL_FILE, TCX_FOLDER, JSON_FILE, file_suffix="tcx")
+    parser = argparse.ArgumentParser()
+    add_loader_args(parser)
+    options = parser.parse_args()
+    if options.watch:
+        watch_activities_file(
+            SQL_FILE,
+            {"tcx": TCX_FOLDER},
+            JSON_FILE,
+            workers=options.workers,
+            chunk_size=options.chunk_size,
+        )
+    else:
+        make_activities_file(
+            SQL_FILE,
+            TCX_FOLDER,
+            JSON_FILE,
+            file_suffix="tcx",
+            workers=options.workers,
+            chunk_size=options.chunk_size,
+        )
@@ -3,6 +3,7 @@ import os
 import time
 
 from config import TCX_FOLDER
+from generator.manifest import DirectoryManifest
 from strava_sync import run_strava_sync
 from stravalib.exc import RateLimitTimeout, ActivityUploadFailed
 from tcxreader.tcxreader import TCXReader
@@ -15,12 +16,11 @@ def get_to_generate_files(last_time):
     reuturn to values one dict for upload
     and one sorted list for next time upload
     """
-    file_names = os.listdir(TCX_FOLDER)
+    file_names = DirectoryManifest(TCX_FOLDER).names("tcx")
     tcx = TCXReader()
     tcx_files = [
         (tcx.read(os.path.join(TCX_FOLDER, i)), os.path.join(TCX_FOLDER, i))
         for i in file_names
-        if i.endswith(".tcx")
     ]
     tcx_files_dict = {
         int(i[0].trackpoints[0].time.timestamp()): i[1]
@@ -0,0 +1,80 @@
+"""
+Time zones of track points and their UTC offsets at a given time.
+
+    zone = zone_at(lat, lon)            # "Asia/Shanghai"
+    local_time = to_local(utc_time, zone)
+    utc_time = to_utc(local_time, zone)
+
+zone_at() remembers the zone of every ZONE_CELL_DEGREES cell it was asked
+for, so the point lookup runs once per place instead of once per track.
+utc_offset() bisects the transition table of the zone, built from pytz once
+per zone: the offset is the one in effect at the given time, so summer and
+winter activities, and ones from years with other rules, are not shifted by
+the offset of today.
+"""
+
+import datetime
+import functools
+from bisect import bisect_right
+
+import pytz
+
+try:
+    from tzfpy import get_tz
+
+    tf = None
+except:
+    from timezonefinder import TimezoneFinder
+
+    tf = TimezoneFinder()
+
+DEFAULT_ZONE = "Asia/Shanghai"
+# about 1 km, points of one cell are taken to be in the same zone
+ZONE_CELL_DEGREES = 0.01
+
+
+@functools.lru_cache(maxsize=4096)
+def _cell_zone(lat_cell, lng_cell):
+    lat, lng = lat_cell * ZONE_CELL_DEGREES, lng_cell * ZONE_CELL_DEGREES
+    try:
+        return get_tz(lng=lng, lat=lat)
+    except:
+        # just a little trick when tzfpy support windows will delete this
+        return tf.timezone_at(lng=lng, lat=lat)
+
+
+def zone_at(lat, lng):
+    """Zone name at (lat, lng), DEFAULT_ZONE where there is none."""
+    zone = _cell_zone(round(lat / ZONE_CELL_DEGREES), round(lng / ZONE_CELL_DEGREES))
+    return zone or DEFAULT_ZONE
+
+
+@functools.lru_cache(maxsize=None)
+def _transitions(zone):
+    """(naive UTC transition times, utcoffset from each of them) of zone."""
+    tz = pytz.timezone(zone)
+    times = getattr(tz, "_utc_transition_times", None)
+    if not times:
+        # UTC and the other fixed offset zones
+        return [datetime.datetime.min], [tz.utcoffset(datetime.datetime.min)]
+    return times, [info[0] for info in tz._transition_info]
+
+
+def utc_offset(zone, utc_time):
+    """utcoffset of zone at utc_time, a naive UTC or an aware datetime."""
+    if utc_time.tzinfo is not None:
+        utc_time = utc_time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    times, offsets = _transitions(zone)
+    return offsets[max(bisect_right(times, utc_time) - 1, 0)]
+
+
+def to_local(utc_time, zone):
+    return utc_time + utc_offset(zone, utc_time)
+
+
+def to_utc(local_time, zone):
+    # the offset of the local time read as UTC is off by at most a few hours,
+    # close to a transition the second lookup gets the right side of it;
+    # the repeated hour when clocks go back is read as standard time
+    offset = utc_offset(zone, local_time)
+    return local_time - utc_offset(zone, local_time - offset)
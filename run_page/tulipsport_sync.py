@@ -1,7 +1,6 @@
 import argparse
 import base64
 import hashlib
-import json
 import os
 import time
 import zlib
@@ -10,11 +9,12 @@ from collections import namedtuple
 from datetime import datetime, timedelta, timezone
 from urllib.parse import quote
 import gpxpy
-import polyline
+import polyline_simplifier
 import requests
 import eviltransform
 from config import GPX_FOLDER, JSON_FILE, SQL_FILE, run_map, start_point
 from generator import Generator
+from generator.manifest import DirectoryManifest
 from xml.etree import ElementTree
 from utils import adjust_time, adjust_time_to_utc
 
@@ -119,7 +119,7 @@ def merge_summary_and_detail_to_nametuple(summary, detail):
                 last_point[6]
             ) - datetime.fromisoformat(first_point[6])
             latlng_list = [[float(point[0]), float(point[1])] for point in point_list]
-            map = run_map(polyline.encode(latlng_list))
+            map = polyline_simplifier.simplified_map(latlng_list)
 
     activity_db_instance = {
         "id": id,
@@ -155,23 +155,26 @@ def find_last_tulipsport_start_time(track_ids):
     return start_time
 
 
-def get_new_activities(token, old_tracks_ids, with_gpx=False):
+def get_new_activities(token, sync_state, with_gpx=False):
     s = requests.Session()
     headers = {"Authorization": token}
-    activity_summary_list = get_all_activity_summaries(
-        s, headers, find_last_tulipsport_start_time(old_tracks_ids)
-    )
+    if sync_state.cursor:
+        last_start_time = datetime.fromtimestamp(
+            int(sync_state.cursor), DEFAULT_TIMEZONE
+        )
+    else:
+        last_start_time = find_last_tulipsport_start_time(sync_state.known)
+    activity_summary_list = get_all_activity_summaries(s, headers, last_start_time)
     activity_summary_list = [
         activity
         for activity in activity_summary_list
-        if activity["id"] not in old_tracks_ids
+        if activity["id"] not in sync_state
     ]
     print(f"{len(activity_summary_list)} new activities to generate")
     tracks = []
     if with_gpx and not os.path.exists(GPX_FOLDER):
         os.mkdir(GPX_FOLDER)
-    old_gpx_ids = os.listdir(GPX_FOLDER)
-    old_gpx_ids = [i.split(".")[0] for i in old_gpx_ids if not i.startswith(".")]
+    old_gpx_ids = DirectoryManifest(GPX_FOLDER).ids()
     for activity_summary in activity_summary_list:
         activity_id = activity_summary["aid"]
         print(f"parsing activity id {activity_id}")
@@ -255,13 +258,16 @@ def build_tulipsport_int_activity_id(activity):
 
 def sync_tulipsport_activites(token, with_gpx=False):
     generator = Generator(SQL_FILE)
-    old_tracks_ids = generator.get_old_tracks_ids()
-    new_tracks = get_new_activities(token, old_tracks_ids, with_gpx)
-    generator.sync_from_app(new_tracks)
+    sync_state = generator.sync_state("tulipsport", id_prefix=TULIPSPORT_FAKE_ID_PREFIX)
+    new_tracks = get_new_activities(token, sync_state, with_gpx)
+    synced_ids = generator.sync_from_app(new_tracks)
+    sync_state.update(synced_ids)
+    # the start timestamp is encoded in the built id, see below
+    for run_id in synced_ids:
+        sync_state.advance(str(run_id)[len(TULIPSPORT_FAKE_ID_PREFIX) : -6])
+    sync_state.save()
 
-    activities_list = generator.load()
-    with open(JSON_FILE, "w") as f:
-        json.dump(activities_list, f)
+    generator.export_json(JSON_FILE)
 
 
 if __name__ == "__main__":
@@ -1,30 +1,28 @@
-import json
 import time
 from datetime import datetime
 
-import pytz
+import timezone_resolver
 
 try:
     from rich import print
 except:
     pass
-from generator import Generator
+from generator import Generator, watch
 from stravalib.client import Client
 from stravalib.exc import RateLimitExceeded
 
 
 def adjust_time(time, tz_name):
-    tc_offset = datetime.now(pytz.timezone(tz_name)).utcoffset()
-    return time + tc_offset
+    return timezone_resolver.to_local(time, tz_name)
 
 
 def adjust_time_to_utc(time, tz_name):
-    tc_offset = datetime.now(pytz.timezone(tz_name)).utcoffset()
-    return time - tc_offset
+    return timezone_resolver.to_utc(time, tz_name)
 
 
 def adjust_timestamp_to_utc(timestamp, tz_name):
-    tc_offset = datetime.now(pytz.timezone(tz_name)).utcoffset()
+    local_time = datetime.utcfromtimestamp(int(timestamp))
+    tc_offset = local_time - timezone_resolver.to_utc(local_time, tz_name)
     delta = int(tc_offset.total_seconds())
     return int(timestamp) - delta
 
@@ -48,20 +46,61 @@ def to_date(ts):
     raise ValueError(f"cannot parse timestamp {ts} into date with fmts: {ts_fmts}")
 
 
-def make_activities_file(sql_file, data_dir, json_file, file_suffix="gpx"):
+def make_activities_file(
+    sql_file, data_dir, json_file, file_suffix="gpx", workers=None, chunk_size=None
+):
     generator = Generator(sql_file)
-    generator.sync_from_data_dir(data_dir, file_suffix=file_suffix)
-    activities_list = generator.load()
-    with open(json_file, "w") as f:
-        json.dump(activities_list, f, indent=0)
+    generator.sync_from_data_dir(
+        data_dir, file_suffix=file_suffix, workers=workers, chunk_size=chunk_size
+    )
+    generator.export_json(json_file)
+
+
+def make_activities_file_only(
+    sql_file, data_dir, json_file, file_suffix="gpx", workers=None, chunk_size=None
+):
+    generator = Generator(sql_file)
+    generator.sync_from_data_dir(
+        data_dir, file_suffix=file_suffix, workers=workers, chunk_size=chunk_size
+    )
+    generator.export_json(json_file, for_mapping=True)
 
 
-def make_activities_file_only(sql_file, data_dir, json_file, file_suffix="gpx"):
+def watch_activities_file(
+    sql_file, folders, json_file, for_mapping=False, workers=None, chunk_size=None
+):
+    """Keep importing the files landing in folders, {file suffix: folder}."""
     generator = Generator(sql_file)
-    generator.sync_from_data_dir(data_dir, file_suffix=file_suffix)
-    activities_list = generator.loadForMapping()
-    with open(json_file, "w") as f:
-        json.dump(activities_list, f, indent=0)
+    watch.watch_folders(
+        generator,
+        folders,
+        json_file,
+        for_mapping=for_mapping,
+        workers=workers,
+        chunk_size=chunk_size,
+    )
+
+
+def add_loader_args(parser):
+    """--workers, --chunk-size and --watch for the scripts that parse a data dir."""
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="processes parsing files, defaults to loader.workers or one per CPU",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        dest="chunk_size",
+        type=int,
+        default=None,
+        help="average files per task sent to a process, picked when unset",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running and import new files as they land in the folder",
+    )
 
 
 def make_strava_client(client_id, client_secret, refresh_token):
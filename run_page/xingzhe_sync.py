@@ -197,9 +197,9 @@ if __name__ == "__main__":
         x.login_by_password()
 
     generator = Generator(SQL_FILE)
-    old_tracks_ids = generator.get_old_tracks_ids()
+    sync_state = generator.sync_state("xingzhe")
     tracks = x.get_old_tracks()
-    new_tracks = [i for i in tracks if str(i["id"]) not in old_tracks_ids]
+    new_tracks = [i for i in tracks if i["id"] not in sync_state]
 
     print(f"{len(new_tracks)} new activities to be downloaded")
 
@@ -211,5 +211,7 @@ if __name__ == "__main__":
     loop = asyncio.get_event_loop()
     future = asyncio.ensure_future(download_new_activities())
     loop.run_until_complete(future)
+    sync_state.update(track["id"] for track in new_tracks)
+    sync_state.save()
 
     make_activities_file(SQL_FILE, GPX_FOLDER, JSON_FILE)